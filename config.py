@@ -1,9 +1,11 @@
 import os
+import json
 import configparser
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 
 try:
     import yaml  # type: ignore
+    _SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 except Exception:  # pragma: no cover
     yaml = None
 
@@ -17,6 +19,37 @@ _DEFAULTS = {
     "memento.ini_batch_path": "memento_import.ini",
 }
 
+_ENV_KEYS = tuple(_DEFAULTS)
+
+# ((mtime settings.ini, mtime settings.yaml), override env) -> settings già calcolati
+_cache: Optional[Tuple[Tuple[Any, ...], Dict[str, Any]]] = None
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+# ((path, mtime) di settings.ini, valori appiattiti)
+_ini_cache: Optional[Tuple[Tuple[str, float], Dict[str, Any]]] = None
+
+def invalidate() -> None:
+    """Svuota la cache di load_settings() (utile nei test)."""
+    global _cache, _ini_cache
+    _cache = None
+    _ini_cache = None
+
+def _env_overrides() -> Tuple[Tuple[str, str], ...]:
+    """Override da variabili d'ambiente: 'memento.token', 'MEMENTO.TOKEN' o 'MEMENTO_TOKEN'."""
+    env = os.environ
+    out = []
+    for k in _ENV_KEYS:
+        for variant in (k, k.upper(), k.replace(".", "_").upper()):
+            if variant in env:
+                out.append((k, env[variant]))
+                break
+    return tuple(out)
+
 def _flatten_ini(cfg: configparser.ConfigParser) -> Dict[str, Any]:
     flat: Dict[str, Any] = {}
     for section in cfg.sections():
@@ -26,40 +59,102 @@ def _flatten_ini(cfg: configparser.ConfigParser) -> Dict[str, Any]:
 
 def _flatten_yaml(d: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
     out: Dict[str, Any] = {}
-    for k, v in d.items():
-        key = f"{prefix}{k}" if not prefix else f"{prefix}.{k}"
-        if isinstance(v, dict):
-            out.update(_flatten_yaml(v, key))
-        else:
+    # pila di iteratori invece della ricorsione: stessa visita in profondità
+    # e nell'ordine delle chiavi, quindi su chiavi appiattite uguali vince
+    # sempre l'ultima incontrata, come prima
+    stack = [(prefix, iter(d.items()))]
+    while stack:
+        pre, it = stack[-1]
+        for k, v in it:
+            key = f"{pre}.{k}" if pre else f"{k}"
+            if isinstance(v, dict):
+                stack.append((key, iter(v.items())))
+                break
             out[key] = v
+        else:
+            stack.pop()
     return out
 
+def _load_ini_cached(ini_path: str, mtime: float) -> Dict[str, Any]:
+    """settings.ini appiattito, riparsato (read_string da un'unica lettura) solo se cambia mtime."""
+    global _ini_cache
+    if _ini_cache is not None and _ini_cache[0] == (ini_path, mtime):
+        return _ini_cache[1]
+    with open(ini_path, "r", encoding="utf-8") as f:
+        text = f.read()
+    cfg = configparser.ConfigParser()
+    cfg.read_string(text, source=ini_path)
+    flat = _flatten_ini(cfg)
+    _ini_cache = ((ini_path, mtime), flat)
+    return flat
+
+def _load_yaml_cached(yaml_path: str) -> Any:
+    """Legge yaml_path passando da un sidecar JSON (<yaml_path>.json).
+
+    Il sidecar registra mtime_ns e dimensione del YAML da cui è stato scritto e
+    vale solo se coincidono ancora; altrimenti il YAML viene riparsato e il
+    sidecar riscritto (best effort).
+    """
+    cache_path = yaml_path + ".json"
+    try:
+        st = os.stat(yaml_path)
+        stamp = [st.st_mtime_ns, st.st_size]
+    except OSError:
+        stamp = None
+    if stamp is not None:
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if isinstance(cached, dict) and cached.get("yaml") == stamp:
+                return cached["data"]
+        except Exception:
+            pass
+
+    with open(yaml_path, "r", encoding="utf-8") as f:
+        data = yaml.load(f, Loader=_SafeLoader) or {}
+
+    tmp = cache_path + ".tmp"
+    try:
+        blob = json.dumps({"yaml": stamp, "data": data}, ensure_ascii=False)
+        # chiavi non stringa (es. `1:`) o valori non JSON (date YAML) non
+        # sopravvivono al giro in JSON: niente sidecar
+        if stamp is None or json.loads(blob)["data"] != data:
+            return data
+        with open(tmp, "w", encoding="utf-8", newline="\n") as f:
+            f.write(blob)
+        os.replace(tmp, cache_path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    return data
+
 def load_settings() -> Dict[str, Any]:
+    global _cache
+    env = _env_overrides()
+    sig = ((_mtime("settings.ini"), _mtime("settings.yaml")), env)
+    if _cache is not None and _cache[0] == sig:
+        return _cache[1]
+
     settings: Dict[str, Any] = dict(_DEFAULTS)
 
-    if os.path.exists("settings.ini"):
-        cfg = configparser.ConfigParser()
-        cfg.read("settings.ini", encoding="utf-8")
-        settings.update(_flatten_ini(cfg))
+    if sig[0][0]:
+        settings.update(_load_ini_cached("settings.ini", sig[0][0]))
 
     if os.path.exists("settings.yaml") and yaml is not None:
-        with open("settings.yaml", "r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or {}
+        data = _load_yaml_cached("settings.yaml")
         if isinstance(data, dict):
             settings.update(_flatten_yaml(data))
 
-    for env_key, val in os.environ.items():
-        low = env_key.lower()
-        if low in ("database.path", "memento.mode", "memento.api_url",
-                   "memento.token", "memento.timeout",
-                   "memento.yaml_batch_path", "memento.ini_batch_path"):
-            settings[low] = val
+    settings.update(env)
 
     try:
         settings["memento.timeout"] = int(settings.get("memento.timeout", 20))
     except Exception:
         settings["memento.timeout"] = 20
 
+    _cache = (sig, settings)
     return settings
 
 def get(key: str, default: Any = None) -> Any:
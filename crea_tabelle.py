@@ -1,10 +1,13 @@
 # v1
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import os, sys, re, json, sqlite3
-from memento_import import memento_import_batch as memento_import_batch_ini
+import os, sys, re, json, sqlite3, functools, itertools
+from memento_import import memento_import_batch
+from db_utils import ensure_conn_pragmas, ensure_db_pragmas
 from typing import Any, Dict, List, Optional, Tuple
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from zoneinfo import ZoneInfo
 
 __CREA_TABELLE_VERSION__ = "v15.1"
@@ -19,8 +22,15 @@ try:
 except Exception:
     _HAS_PYMEMENTO=False
 
+try:
+    import orjson
+    _HAS_ORJSON=True
+except Exception:
+    _HAS_ORJSON=False
+
 try:
     import yaml
+    _YamlLoader=getattr(yaml,"CSafeLoader",yaml.SafeLoader)
     _HAS_YAML=True
 except Exception:
     _HAS_YAML=False
@@ -35,6 +45,22 @@ def _json_default(o):
     if isinstance(o,(datetime,date)): return o.isoformat()
     return str(o)
 
+@functools.lru_cache(maxsize=32)
+def _zi(name):
+    return ZoneInfo(name)
+
+_UTC=_zi("UTC")
+_ZERO=timedelta(0)
+
+def _dumps_raw(o):
+    """JSON compatto per la colonna raw: orjson se disponibile, altrimenti json."""
+    if _HAS_ORJSON:
+        try:
+            return orjson.dumps(o, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(o, ensure_ascii=False, default=_json_default)
+
 def _parse_dt_any(v):
     """Ritorna datetime aware; assume UTC se naive."""
     if v is None:
@@ -44,47 +70,86 @@ def _parse_dt_any(v):
     elif isinstance(v, date):
         dt = datetime.fromisoformat(v.isoformat())
     else:
-        s = str(v).strip().replace("T", " ").replace("Z", "+00:00")
-        # Supporta frazioni secondi e offset ISO
-        dt = datetime.fromisoformat(s)
+        try:
+            # Python 3.11+: accetta direttamente separatore "T" e suffisso "Z"
+            dt = datetime.fromisoformat(v)
+        except (TypeError, ValueError):
+            s = str(v).strip().replace("T", " ").replace("Z", "+00:00")
+            # Supporta frazioni secondi e offset ISO
+            dt = datetime.fromisoformat(s)
     if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=ZoneInfo("UTC"))
+        dt = dt.replace(tzinfo=_UTC)
     return dt
 
+# mese 01-12, giorno 01-31, ora 00-23, anno da 0001; giorni oltre il 28 li controlla _iso_day_ok
+_ISO_UTC_RE=re.compile(r"^(?!0000)\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01])[ T](?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d(?:Z|\+00:00)?$")
+_MONTH_DAYS=(0,31,29,31,30,31,30,31,31,30,31,30,31)
+
+def _iso_day_ok(v):
+    """Il giorno esiste nel mese (29 febbraio solo negli anni bisestili)."""
+    d=int(v[8:10])
+    if d<=28: return True
+    m=int(v[5:7])
+    if d>_MONTH_DAYS[m]: return False
+    if m!=2: return True
+    y=int(v[:4]); return y%4==0 and (y%100!=0 or y%400==0)
+
 def _iso_in_policy(v, tz_name: str | None, store_time_as: str = "utc"):
     """
     Converte un valore temporale generico in stringa ISO in base a policy.
     store_time_as: 'utc' | 'local'
     tz_name: es. 'Europe/Copenhagen' (usato solo se store_time_as=local)
     """
+    to_local = (store_time_as or "utc").lower() == "local" and tz_name
+    if not to_local and isinstance(v, str) and _ISO_UTC_RE.match(v) and _iso_day_ok(v):
+        # già ISO in UTC (o naive = UTC), data e ora valide: basta riscrivere la stringa
+        return v[:10] + "T" + v[11:19] + "+00:00"
     dt = _parse_dt_any(v)
     if dt is None:
         return None
-    if (store_time_as or "utc").lower() == "local" and tz_name:
+    if to_local:
         try:
-            dt = dt.astimezone(ZoneInfo(tz_name))
+            dt = dt.astimezone(_zi(tz_name))
         except Exception:
             # Fallback: resta UTC
-            dt = dt.astimezone(ZoneInfo("UTC"))
-    else:
-        dt = dt.astimezone(ZoneInfo("UTC"))
+            dt = dt.astimezone(_UTC)
+    elif dt.utcoffset() != _ZERO:
+        dt = dt.astimezone(_UTC)
     return dt.isoformat(timespec="seconds")
 
-def read_memento_config(path="memento_import.yaml"):
+@functools.lru_cache(maxsize=8)
+def _read_memento_config_cached(path, mtime):
     cfg={}
-    if not _HAS_YAML or not os.path.exists(path): return cfg
     try:
         with open(path,"r",encoding="utf-8") as f:
-            d=yaml.safe_load(f) or {}
+            d=yaml.load(f,Loader=_YamlLoader) or {}
             if isinstance(d,dict): cfg=d
     except Exception: pass
     return cfg
 
+def read_memento_config(path="memento_import.yaml"):
+    """Config YAML memoizzata per (path, mtime): il dict ritornato è condiviso, non modificarlo."""
+    if not _HAS_YAML or not os.path.exists(path): return {}
+    try: mt=os.path.getmtime(path)
+    except OSError: return {}
+    return _read_memento_config_cached(path, mt)
+
 def db_connect(p):
-    c=sqlite3.connect(p); c.row_factory=sqlite3.Row; return c
+    c=sqlite3.connect(p); c.row_factory=sqlite3.Row
+    try:
+        # stessi PRAGMA di connessione di import ed expander (db_utils). WAL cambia il
+        # file per sempre: solo su richiesta (CREA_TABELLE_WAL=1)
+        ensure_conn_pragmas(c)
+        if os.environ.get("CREA_TABELLE_WAL","").strip().lower() in ("1","true","yes","on"):
+            ensure_db_pragmas(c)
+    except sqlite3.Error as e:
+        print(f"[diag] pragma skip: {e}")
+    return c
+
+_NEED_QUOTE=re.compile(r"[^A-Za-z0-9_]")
 
 def quote_ident(n:str)->str:
-    return ('"' + n.replace('"','""') + '"' ) if re.search(r"[^A-Za-z0-9_]",n) else n
+    return ('"' + n.replace('"','""') + '"' ) if _NEED_QUOTE.search(n) else n
 
 def ensure_audit_tables(conn):
     conn.execute(f"""CREATE TABLE IF NOT EXISTS {quote_ident(AUDIT_DDL)} (
@@ -117,22 +182,32 @@ def _first_present_name(pref, avail):
         if p.lower() in low: return low[p.lower()]
     return None
 
-def audit_schema(conn, action, object_type, object_name, details=None):
+@functools.lru_cache(maxsize=16)
+def _audit_plan_for(cols):
+    """(insert_sql, maschera dei valori presenti) per le colonne di audit_schema,
+    oppure None se la tabella non è usabile. Chiave = colonne: vale per ogni
+    connessione e segue ALTER/DROP senza invalidazioni."""
+    names=(_first_present_name(["action","azione"],cols),
+           _first_present_name(["object_type","oggetto_tipo","tipo"],cols),
+           _first_present_name(["object_name","oggetto_nome","nome"],cols),
+           _first_present_name(["details","dettaglio","dettagli","extra"],cols))
+    present=[n for n in names if n]
+    if not present: return None
+    cols_sql=", ".join(quote_ident(k) for k in present); ph=", ".join(["?"]*len(present))
+    return (f"INSERT INTO {quote_ident(AUDIT_DDL)} ({cols_sql}) VALUES ({ph})", tuple(bool(n) for n in names))
+
+def _audit_plan(conn):
     cols=_table_columns(conn,AUDIT_DDL)
-    if not cols: return
-    vm={}
-    a=_first_present_name(["action","azione"],cols)
-    t=_first_present_name(["object_type","oggetto_tipo","tipo"],cols)
-    n=_first_present_name(["object_name","oggetto_nome","nome"],cols)
-    d=_first_present_name(["details","dettaglio","dettagli","extra"],cols)
-    if a: vm[a]=action
-    if t: vm[t]=object_type
-    if n: vm[n]=object_name
-    if d: vm[d]= json.dumps(details,ensure_ascii=False,default=_json_default) if isinstance(details,dict) else ("" if details is None else str(details))
-    if not vm: return
-    cols_sql=", ".join(quote_ident(k) for k in vm.keys()); ph=", ".join(["?"]*len(vm))
+    return _audit_plan_for(tuple(cols)) if cols else None
+
+def audit_schema(conn, action, object_type, object_name, details=None):
+    plan=_audit_plan(conn)
+    if not plan: return
+    sql,mask=plan
+    d=json.dumps(details,ensure_ascii=False,default=_json_default) if isinstance(details,dict) else ("" if details is None else str(details))
+    vals=[v for v,keep in zip((action,object_type,object_name,d),mask) if keep]
     try:
-        conn.execute(f"INSERT INTO {quote_ident(AUDIT_DDL)} ({cols_sql}) VALUES ({ph})", list(vm.values()))
+        conn.execute(sql, vals)
         conn.commit()
     except sqlite3.Error as e:
         print(f"[diag] audit_schema insert skip: {e}")
@@ -156,22 +231,51 @@ def sdk_list_libraries(srv):
     except Exception as e:
         print(f"[ERRORE] list_libraries: {type(e).__name__}: {_short(e)}"); return []
 
-def sdk_get_entries(srv, lib_id, limit=None, offset=None):
+def sdk_get_entries(srv, lib_id, limit=None, offset=None, start_revision=None):
     try:
-        if limit is None and offset is None:
-            entries=srv.get_entries(lib_id) or []
-        elif offset is None:
-            entries=srv.get_entries(lib_id, limit=limit or 1000) or []
-        else:
-            entries=srv.get_entries(lib_id, limit=limit or 1000, offset=offset) or []
+        kw={}
+        if limit is not None or offset is not None: kw["limit"]=limit or 1000
+        if offset is not None: kw["offset"]=offset
+        if start_revision is not None: kw["start_revision"]=start_revision
+        entries=srv.get_entries(lib_id, **kw) or []
         return [ getattr(e,"__dict__",e) for e in entries ]
     except Exception as e:
         print(f"[diag] get_entries: {type(e).__name__}: {_short(e)}"); return []
 
+def _next_page_args(batch, limit, rev, page):
+    """Argomenti di sdk_get_entries per la pagina dopo batch (None se era l'ultima)."""
+    if limit is None or len(batch)<limit: return None
+    revs=[e.get("revision") for e in batch]
+    if all(type(r) is int for r in revs) and revs==sorted(revs):
+        if revs[-1]!=rev: return {"limit":page, "start_revision":revs[-1]}
+        # pagina piena tutta della stessa revisione: il resto da lì in una richiesta
+        return {"limit":None, "start_revision":rev}
+    # revisioni assenti o fuori ordine: niente paging, il resto in una richiesta
+    return {"limit":None, "start_revision":None}
+
+def sdk_iter_pages(srv, lib_id, first=100, page=1000):
+    """Entry della libreria a pagine; la prima (first entry) fa da campione per la mappatura.
+    Memento.get_entries non ha offset ma restituisce le entry in ordine di modifica, quindi
+    di revisione: ogni pagina riparte con start_revision dalla revisione più alta vista
+    (inclusa, per le entry a pari revisione rimaste fuori) e salta gli id già dati.
+    La pagina successiva si scarica in un thread mentre il chiamante importa la corrente."""
+    seen=set(); args={"limit":first, "start_revision":None}
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        fut=ex.submit(sdk_get_entries, srv, lib_id, **args)
+        while fut is not None:
+            batch=fut.result()
+            args=_next_page_args(batch, args["limit"], args["start_revision"], page)
+            fut=ex.submit(sdk_get_entries, srv, lib_id, **args) if args else None
+            out=[e for e in batch if e.get("id") is None or e.get("id") not in seen]
+            seen.update(e.get("id") for e in out)
+            if out: yield out
+
 # ------------------------- Mapping euristico -------------------------
+_ISO_DT_RE=re.compile(r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}")
+
 def detect_datetime_like(v):
     if isinstance(v,(datetime,date)): return True
-    if isinstance(v,str) and re.match(r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}", v.strip()): return True
+    if isinstance(v,str) and _ISO_DT_RE.match(v.strip()): return True
     return False
 
 def detect_small_int(v):
@@ -186,24 +290,24 @@ def detect_small_int(v):
     return False
 
 def deduce_mapping_from_entries(entries):
-    vt,vm,vn={}, {}, {}
-    for e in entries[:min(len(entries),50)]:
+    vt,vm,vn=Counter(),Counter(),Counter()
+    def tally(k,v):
+        if detect_datetime_like(v): vt[k]+=1
+        elif detect_small_int(v): vm[k]+=1
+        elif isinstance(v,str) and v.strip(): vn[k]+=1
+    for e in entries[:50]:
         fields=e.get("fields") or e.get("values") or e.get("data") or []
         if isinstance(fields,list):
             for it in fields:
                 if not isinstance(it,dict): continue
-                fid=it.get("id"); val=it.get("value")
+                fid=it.get("id")
                 if fid is None: continue
-                if detect_datetime_like(val): vt[fid]=vt.get(fid,0)+1
-                elif detect_small_int(val): vm[fid]=vm.get(fid,0)+1
-                elif isinstance(val,str) and val.strip(): vn[fid]=vn.get(fid,0)+1
+                tally(fid,it.get("value"))
         elif isinstance(fields,dict):
-            for k,v in fields.items():
-                if detect_datetime_like(v): vt[k]=vt.get(k,0)+1
-                elif detect_small_int(v): vm[k]=vm.get(k,0)+1
-                elif isinstance(v,str) and v.strip(): vn[k]=vn.get(k,0)+1
+            for k,v in fields.items(): tally(k,v)
     def top(d):
-        return None if not d else sorted(d.items(), key=lambda kv:(-kv[1], str(kv[0])))[0][0]
+        # conteggio più alto; a parità, chiave minore come stringa
+        return None if not d else min(d, key=lambda k:(-d[k], str(k)))
     return {"tempo_id": top(vt), "umore_id": top(vm), "note_id": top(vn)}
 
 # ------------------------- DDL & import -------------------------
@@ -251,72 +355,173 @@ def create_time_indexes(conn, table, tempo_col, create_second):
             print(f"[diag] idx second skip: {e}")
     conn.commit()
 
-def import_entries(conn, table, entries, mapping, id_mode, tempo_col, prefer_time, tz_name, store_time_as):
-    ins=upd=0; second_used=None
+# entry per blocco in import_entries (una query IN per blocco, executemany per le righe)
+_KEYS_CHUNK=2000
+
+def _keys_chunk(conn):
+    """Blocco effettivo (CREA_TABELLE_CHUNK, default 2000): mai oltre i parametri ammessi
+    da questa build di SQLite (32766 da 3.32, 999 prima)."""
+    try:
+        want=int(os.environ.get("CREA_TABELLE_CHUNK", _KEYS_CHUNK))
+    except ValueError:
+        print(f"[diag] CREA_TABELLE_CHUNK non valido: uso {_KEYS_CHUNK}"); want=_KEYS_CHUNK
+    try:
+        limit=conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    except AttributeError:  # Python < 3.11
+        limit=32766 if sqlite3.sqlite_version_info>=(3,32,0) else 999
+    return max(1, min(want, limit))
+
+@functools.lru_cache(maxsize=64)
+def _keys_sql(table, id_mode, n):
+    key_col="ext_id" if id_mode=="surrogate" else "id"
+    return f"SELECT {key_col} FROM {quote_ident(table)} WHERE {key_col} IN ({','.join('?'*n)})"
+
+@functools.lru_cache(maxsize=32)
+def _import_sql(table, tempo_col, id_mode, upsert=True):
+    """INSERT (UPSERT se upsert=True) per import_entries, costruito una volta per tabella/modalità."""
+    qt=quote_ident(table); qc=quote_ident(tempo_col)
+    if id_mode=="surrogate":
+        sql=f"INSERT INTO {qt} (ext_id, {qc}, second_time, umore, note, createdTime, modifiedTime, raw) VALUES (?,?,?,?,?,?,?,?)"
+        if upsert:
+            sql+=(f" ON CONFLICT(ext_id) DO UPDATE SET {qc}=excluded.{qc}, second_time=excluded.second_time, umore=excluded.umore, note=excluded.note, "
+                  f"createdTime=excluded.createdTime, modifiedTime=excluded.modifiedTime, raw=excluded.raw")
+    else:
+        sql=f"INSERT INTO {qt} (id, {qc}, second_time, umore, note, ext_id, createdTime, modifiedTime, raw) VALUES (?,?,?,?,?,?,?,?,?)"
+        if upsert:
+            sql+=(f" ON CONFLICT(id) DO UPDATE SET {qc}=excluded.{qc}, second_time=excluded.second_time, umore=excluded.umore, note=excluded.note, "
+                  f"ext_id=excluded.ext_id, createdTime=excluded.createdTime, modifiedTime=excluded.modifiedTime, raw=excluded.raw")
+    return sql
+
+@functools.lru_cache(maxsize=32)
+def _update_sql(table, tempo_col, id_mode):
+    """UPDATE per chiave (tabelle senza vincolo UNIQUE): parametri = riga[1:] + riga[:1]."""
+    qt=quote_ident(table); qc=quote_ident(tempo_col)
+    if id_mode=="surrogate":
+        return (f"UPDATE {qt} SET {qc}=?, second_time=?, umore=?, note=?, createdTime=?, modifiedTime=?, raw=? WHERE ext_id=?")
+    return (f"UPDATE {qt} SET {qc}=?, second_time=?, umore=?, note=?, ext_id=?, createdTime=?, modifiedTime=?, raw=? WHERE id=?")
+
+def _ensure_upsert_key(conn, table, id_mode):
+    """True se la colonna chiave ha un vincolo PK/UNIQUE (ON CONFLICT utilizzabile).
+    Tabelle esistenti senza vincolo: si prova a creare l'indice UNIQUE; con chiavi già
+    duplicate non si può, e import_entries passa a UPDATE/INSERT per riga."""
+    key_col="ext_id" if id_mode=="surrogate" else "id"
+    qt=quote_ident(table)
+    pk=[r[1] for r in conn.execute(f"PRAGMA table_info({qt})") if r[5]]
+    if pk==[key_col]: return True
+    for r in conn.execute(f"PRAGMA index_list({qt})").fetchall():
+        if r[2] and not r[4] and [c[2] for c in conn.execute(f"PRAGMA index_info({quote_ident(r[1])})")]==[key_col]:
+            return True
+    idx=table+'_'+key_col+'_unique'
+    try:
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {quote_ident(idx)} ON {qt} ({key_col})")
+        conn.commit()
+        print(f"[diag] {table}: creato indice UNIQUE {idx} su {key_col} (serve all'UPSERT)")
+        return True
+    except sqlite3.IntegrityError as e:
+        print(f"[diag] {table}.{key_col} non univoco ({_short(e)}): UPDATE/INSERT per riga")
+        return False
+
+def _times_auto(ft, created, modified):
+    pt=ft or created or modified
+    return pt, next((c for c in (created, modified, ft) if c is not None and c!=pt), None)
+
+def _times_field(ft, created, modified):
+    return (ft, created or modified) if ft is not None else _times_auto(ft, created, modified)
+
+def _times_created(ft, created, modified):
+    return (created, ft or modified) if created is not None else _times_auto(ft, created, modified)
+
+def _times_modified(ft, created, modified):
+    return (modified, ft or created) if modified is not None else _times_auto(ft, created, modified)
+
+# selezione tempo primario/secondario per prefer_time
+_TIME_PICKERS={"auto":_times_auto, "field":_times_field, "created":_times_created, "modified":_times_modified}
+
+def _as_umore(v):
+    if isinstance(v,bool): return int(v)
+    if isinstance(v,int): return v
+    if isinstance(v,str) and v.strip().lstrip("-").isdigit():
+        try: return int(v.strip())
+        except: return None
+    return None
+
+def _as_note(v):
+    return v.isoformat() if isinstance(v,(datetime,date)) else (str(v) if v is not None else None)
+
+def _fields_dict(e):
+    fields=e.get("fields") or e.get("values") or e.get("data") or []
+    if isinstance(fields,list):
+        return {it["id"]:it.get("value") for it in fields if isinstance(it,dict) and "id" in it}
+    if isinstance(fields,dict): return dict(fields)
+    return {}
+
+def _none(fd):
+    return None
+
+def _entry_row_builder(mapping, id_mode, prefer_time, tz_name, store_time_as):
+    """Ritorna build(e, ext_id) -> tupla parametri dell'UPSERT.
+
+    Mapping, prefer_time e id_mode vengono risolti qui una volta sola:
+    il loop di import non ridecide per ogni riga.
+    """
     tempo_id=mapping.get("tempo_id"); umore_id=mapping.get("umore_id"); note_id=mapping.get("note_id")
-    for e in entries:
-        ext_id=e.get("id")
-        if not ext_id: continue
-        fields=e.get("fields") or e.get("values") or e.get("data") or []
-        fdict={}
-        if isinstance(fields,list):
-            for it in fields:
-                if isinstance(it,dict) and "id" in it: fdict[it["id"]]=it.get("value")
-        elif isinstance(fields,dict): fdict=dict(fields)
-        field_time=fdict.get(tempo_id) if tempo_id is not None else None
+    pick=_TIME_PICKERS.get(prefer_time, _times_auto)
+    get_time =(lambda fd: fd.get(tempo_id)) if tempo_id is not None else _none
+    get_umore=(lambda fd: _as_umore(fd.get(umore_id))) if umore_id is not None else _none
+    get_note =(lambda fd: _as_note(fd.get(note_id))) if note_id is not None else _none
+    surrogate=id_mode=="surrogate"
+    def iso(v):
+        return _iso_in_policy(v, tz_name, store_time_as) if v is not None else None
+    def build(e, ext_id):
+        fd=_fields_dict(e)
         created=e.get("createdTime"); modified=e.get("modifiedTime")
-        # selezione primario/secondario
-        if prefer_time=="field" and field_time is not None:
-            pt=field_time; st=created or modified
-        elif prefer_time=="created" and created is not None:
-            pt=created; st=field_time or modified
-        elif prefer_time=="modified" and modified is not None:
-            pt=modified; st=field_time or created
-        else:
-            pt=field_time or created or modified
-            st= next((c for c in [created, modified, field_time] if c is not None and c!=pt), None)
-        tempo_val   = _iso_in_policy(pt, tz_name, store_time_as) if pt is not None else None
-        second_val  = _iso_in_policy(st, tz_name, store_time_as) if st is not None else None
-        if second_val is not None: second_used="second_time"
-        # umore
-        uv=None
-        if umore_id is not None:
-            v=fdict.get(umore_id)
-            if isinstance(v,bool): uv=int(v)
-            elif isinstance(v,int): uv=v
-            elif isinstance(v,str) and v.strip().lstrip("-").isdigit():
-                try: uv=int(v.strip())
-                except: uv=None
-        # note
-        nv=None
-        if note_id is not None:
-            v=fdict.get(note_id)
-            nv=v.isoformat() if isinstance(v,(datetime,date)) else (str(v) if v is not None else None)
-        # meta
-        created_str = _iso_in_policy(created, tz_name, store_time_as) if created is not None else None
-        modified_str= _iso_in_policy(modified, tz_name, store_time_as) if modified is not None else None
-        raw_json = json.dumps(e, ensure_ascii=False, default=_json_default)
-
-        if id_mode=="surrogate":
-            row=conn.execute(f"SELECT ext_id FROM {quote_ident(table)} WHERE ext_id=?", (ext_id,)).fetchone()
-            if row:
-                conn.execute(f"UPDATE {quote_ident(table)} SET {quote_ident(tempo_col)}=?, second_time=?, umore=?, note=?, createdTime=?, modifiedTime=?, raw=? WHERE ext_id=?",
-                             (tempo_val, second_val, uv, nv, created_str, modified_str, raw_json, ext_id))
+        pt,st=pick(get_time(fd), created, modified)
+        if surrogate:
+            return (ext_id, iso(pt), iso(st), get_umore(fd), get_note(fd), iso(created), iso(modified), _dumps_raw(e))
+        return (ext_id, iso(pt), iso(st), get_umore(fd), get_note(fd), ext_id, iso(created), iso(modified), _dumps_raw(e))
+    return build
+
+def import_entries(conn, table, entries, mapping, id_mode, tempo_col, prefer_time, tz_name, store_time_as):
+    ins=upd=0; second_used=None
+    upsert=_ensure_upsert_key(conn, table, id_mode)
+    sql=_import_sql(table, tempo_col, id_mode, upsert)
+    upd_sql=None if upsert else _update_sql(table, tempo_col, id_mode)
+    build=_entry_row_builder(mapping, id_mode, prefer_time, tz_name, store_time_as)
+    cur=conn.cursor(); cur.row_factory=None  # tuple semplici: niente sqlite3.Row per riga
+    # chiavi già in tabella o già viste in questo import: bastano per contare inserite/aggiornate
+    existing=set()
+
+    def rows(chunk, updates=None):
+        # updates: lista per le righe già presenti (solo senza UPSERT); le altre si inseriscono
+        nonlocal ins, upd, second_used
+        for e in chunk:
+            ext_id=e.get("id")
+            if not ext_id: continue
+            k=str(ext_id)
+            row=build(e, ext_id)
+            if row[2] is not None: second_used="second_time"
+            if k in existing:
                 upd+=1
-            else:
-                conn.execute(f"INSERT INTO {quote_ident(table)} (ext_id, {quote_ident(tempo_col)}, second_time, umore, note, createdTime, modifiedTime, raw) VALUES (?,?,?,?,?,?,?,?)",
-                             (ext_id, tempo_val, second_val, uv, nv, created_str, modified_str, raw_json))
-                ins+=1
+                if updates is not None:
+                    updates.append(row[1:]+row[:1]); continue
+            else: existing.add(k); ins+=1
+            yield row
+
+    # a blocchi: si cercano solo le chiavi del blocco (sull'indice), non tutta la tabella
+    it=iter(entries); n=_keys_chunk(conn)
+    while True:
+        chunk=list(itertools.islice(it, n))
+        if not chunk: break
+        keys=list({str(e.get("id")) for e in chunk if e.get("id")} - existing)
+        if keys:
+            existing.update(r[0] for r in cur.execute(_keys_sql(table, id_mode, len(keys)), keys))
+        if upsert:
+            cur.executemany(sql, rows(chunk))
         else:
-            row=conn.execute(f"SELECT id FROM {quote_ident(table)} WHERE id=?", (ext_id,)).fetchone()
-            if row:
-                conn.execute(f"UPDATE {quote_ident(table)} SET {quote_ident(tempo_col)}=?, second_time=?, umore=?, note=?, ext_id=?, createdTime=?, modifiedTime=?, raw=? WHERE id=?",
-                             (tempo_val, second_val, uv, nv, ext_id, created_str, modified_str, raw_json, ext_id))
-                upd+=1
-            else:
-                conn.execute(f"INSERT INTO {quote_ident(table)} (id, {quote_ident(tempo_col)}, second_time, umore, note, ext_id, createdTime, modifiedTime, raw) VALUES (?,?,?,?,?,?,?,?,?)",
-                             (ext_id, tempo_val, second_val, uv, nv, ext_id, created_str, modified_str, raw_json))
-                ins+=1
+            # prima gli INSERT: un id ripetuto nel blocco si aggiorna dopo essere stato inserito
+            updates=[]
+            cur.executemany(sql, rows(chunk, updates))
+            cur.executemany(upd_sql, updates)
     conn.commit()
     return ins, upd, tempo_col, second_used
 
@@ -376,12 +581,14 @@ def _do_one_import(conn, srv, lib_id, table, id_mode, prefer_time, time_column_n
     prefer_time=(prefer_time or "auto").lower()
     if prefer_time not in ("auto","field","created","modified"): prefer_time="auto"
     tempo_col=time_column_name or "tempo"
-    sample=sdk_get_entries(srv, lib_id, limit=100)
+    pages=sdk_iter_pages(srv, lib_id)
+    sample=next(pages, None)
     if not sample:
         print(f"[ERRORE] Nessuna entry visibile per {lib_id}."); return (0,0)
     mapping=deduce_mapping_from_entries(sample)
     ensure_import_table(conn, table, id_mode, tempo_col)
-    entries=sdk_get_entries(srv, lib_id) or sample
+    # la prima pagina serve sia per la mappatura sia per l'import: una sola passata
+    entries=itertools.chain(sample, itertools.chain.from_iterable(pages))
     ins, upd, primary_used, second_used = import_entries(conn, table, entries, mapping, id_mode, tempo_col, prefer_time, tz_name, store_time_as)
     create_time_indexes(conn, table, tempo_col, bool(index_second_time and second_used))
     audit_schema(conn, "CLOUD_IMPORT", "table", table, f"importate {ins} righe da memento per la libreria {lib_id}")
@@ -407,59 +614,6 @@ def memento_import_singolo(conn):
     if not srv: return
     _do_one_import(conn, srv, lib_id, table, id_mode, prefer_time, time_column_name, index_second_time, tz_name, store_time_as)
 
-def memento_import_batch(conn):
-    print("\n================ MEMENTO — Import batch da YAML ================")
-    cfg=read_memento_config(); token=(cfg.get("token") or "").strip()
-    default=cfg.get("default",{}) if isinstance(cfg.get("default"),dict) else {}
-    id_mode_def=default.get("id_mode") or "external"
-    prefer_time_def=default.get("prefer_time") or "auto"
-    time_column_name_def=default.get("time_column_name") or "tempo"
-    index_second_time_def=bool(default.get("index_second_time", False))
-    tz_name_def=default.get("timezone") or None
-    store_time_as_def=(default.get("store_time_as") or "utc").lower()
-    libs_cfg=cfg.get("libraries") if isinstance(cfg,dict) else None
-    if not token:
-        print("[ERRORE] Manca token in YAML (chiave: token)."); return
-    if not libs_cfg or not isinstance(libs_cfg, list):
-        print("[ERRORE] Manca lista 'libraries' in YAML. Esempio:")
-        print("""\
-token: TUO_TOKEN
-default:
-  id_mode: external
-  prefer_time: auto
-  time_column_name: tempo
-  index_second_time: false
-  timezone: Europe/Copenhagen
-  store_time_as: local
-libraries:
-  - id: wn8JsQymR
-    table: umore
-    id_mode: surrogate
-    prefer_time: field
-    time_column_name: tempo
-    index_second_time: true
-  - id: r7JvCKmKc
-    table: ansia
-""".strip()); return
-    srv=sdk_connect(token)
-    if not srv: return
-    total_ins=total_upd=0
-    for item in libs_cfg:
-        if not isinstance(item,dict): continue
-        lib_id=str(item.get("id") or "").strip()
-        if not lib_id:
-            print("[skip] elemento senza id"); continue
-        table=str(item.get("table") or f"memento_{lib_id}").strip()
-        id_mode=item.get("id_mode") or id_mode_def
-        prefer_time=item.get("prefer_time") or prefer_time_def
-        time_column_name=item.get("time_column_name") or time_column_name_def
-        index_second_time=bool(item.get("index_second_time", index_second_time_def))
-        tz_name=item.get("timezone") or tz_name_def
-        store_time_as=(item.get("store_time_as") or store_time_as_def).lower()
-        ins, upd = _do_one_import(conn, srv, lib_id, table, id_mode, prefer_time, time_column_name, index_second_time, tz_name, store_time_as)
-        total_ins+=ins; total_upd+=upd
-    print(f"[OK] Batch completato. Totale inserite {total_ins}, aggiornate {total_upd}.")
-
 # ------------------------- Flussi SQLite -------------------------
 def flow_add_table(conn):
     print("\n================ Aggiungi tabella ================")
@@ -498,7 +652,7 @@ def flow_edit_table(conn):
         elif sel=="3":
             if input("Confermi ELIMINA TABELLA? digita 'SI': ").strip()=="SI":
                 try:
-                    conn.execute(f"DROP TABLE IF EXISTS {quote_ident(table)}"); conn.commit();
+                    conn.execute(f"DROP TABLE IF EXISTS {quote_ident(table)}"); conn.commit()
                     audit_schema(conn,"ELIMINA_TABELLA","table",table,"tabella eliminata"); print(f"[OK] Tabella '{table}' eliminata."); break
                 except sqlite3.Error as e:
                     print(f"[ERRORE] DROP TABLE fallito: {e}")
@@ -564,7 +718,7 @@ def main():
                     batch_path = input("Percorso batch YAML/INI [memento_import.ini]: ").strip() or "memento_import.ini"
                     # usa l'implementazione nuova (INI/YAML + sync incremental)
                     try:
-                        n = memento_import_batch_ini(db_path, batch_path)
+                        n = memento_import_batch(db_path, batch_path)
                         print(f"\n[INFO] Righe importate: {n}")
                     except Exception as e:
                         print(f"\n[ERRORE] Import batch fallito: {e}")
@@ -1,16 +1,57 @@
+import functools
 import sqlite3
-from typing import Set
+from typing import Dict, FrozenSet, Optional, Set, Tuple
 
+# Introspezione schema per file di database, valida finché non cambia PRAGMA
+# schema_version (ogni CREATE/ALTER/DROP, da qualunque connessione, lo incrementa).
+# Non per id(conn): CPython riusa l'id di una connessione chiusa per la successiva.
+_SCHEMA_CACHE: Dict[str, Tuple[int, Dict[str, FrozenSet[str]]]] = {}
+
+@functools.lru_cache(maxsize=1024)
 def quote_ident(name: str) -> str:
     if name is None:
         raise ValueError("Identifier cannot be None")
     return '"' + str(name).replace('"', '""') + '"'
 
+def _schema_cache(conn: sqlite3.Connection) -> Optional[Dict[str, FrozenSet[str]]]:
+    """Colonne memorizzate per il database di conn; None se non si può usare la cache:
+    database senza file (:memory:) o transazione aperta (schema non ancora committato)."""
+    if conn.in_transaction:
+        return None
+    path, version = conn.execute(
+        "SELECT (SELECT file FROM pragma_database_list WHERE name='main'),"
+        " (SELECT schema_version FROM pragma_schema_version)").fetchone()
+    if not path:
+        return None
+    entry = _SCHEMA_CACHE.get(path)
+    if entry is None or entry[0] != version:
+        entry = _SCHEMA_CACHE[path] = (version, {})
+    return entry[1]
+
+def invalidate_schema(conn: sqlite3.Connection, table: str = None) -> None:
+    cache = _schema_cache(conn)
+    if cache is None:
+        return
+    if table is None:
+        cache.clear()
+    else:
+        cache.pop(table, None)
+
 def table_columns(conn: sqlite3.Connection, table: str) -> Set[str]:
-    cur = conn.execute(f"PRAGMA table_info({quote_ident(table)})")
-    return {row[1] for row in cur.fetchall()}
+    """Colonne di table (copia: il chiamante può modificarla)."""
+    cache = _schema_cache(conn)
+    cols = cache.get(table) if cache is not None else None
+    if cols is None:
+        cur = conn.execute(f"PRAGMA table_info({quote_ident(table)})")
+        cols = frozenset(row[1] for row in cur.fetchall())
+        if cols and cache is not None:  # una tabella che non esiste ancora non va memorizzata
+            cache[table] = cols
+    return set(cols)
 
 def table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    cache = _schema_cache(conn)
+    if cache is not None and table in cache:
+        return True
     cur = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
     return cur.fetchone() is not None
 
@@ -24,25 +65,68 @@ def ensure_ext_id(conn: sqlite3.Connection, table: str) -> str:
         except sqlite3.OperationalError:
             pass
         conn.commit()
+        invalidate_schema(conn, table)
     return 'ext_id'
 
-def ensure_pragmas(conn: sqlite3.Connection):
-    conn.execute("PRAGMA journal_mode=WAL")
+def ensure_db_pragmas(conn: sqlite3.Connection, page_size: int = 0):
+    """PRAGMA persistenti nel file (page_size, journal_mode): vanno impostati una
+    volta per database, poi si controllano soltanto."""
+    if page_size and conn.execute("PRAGMA page_size").fetchone()[0] != page_size:
+        # page_size non cambia in WAL: si esce da WAL, VACUUM, e si rientra
+        conn.commit()
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute(f"PRAGMA page_size={int(page_size)}")
+        conn.execute("VACUUM")
+    if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() != "wal":
+        conn.execute("PRAGMA journal_mode=WAL")
+
+def ensure_conn_pragmas(conn: sqlite3.Connection):
+    """PRAGMA che valgono solo per la connessione: a ogni apertura, senza memo (costano poco)."""
     conn.execute("PRAGMA synchronous=NORMAL")
     conn.execute("PRAGMA temp_store=MEMORY")
-    conn.execute("PRAGMA cache_size=-20000")
-    conn.commit()
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA busy_timeout=5000")
+    # limita il lavoro di ANALYZE fatto da PRAGMA optimize
+    conn.execute("PRAGMA analysis_limit=400")
 
-def ensure_indexes(conn: sqlite3.Connection, table: str, tempo_col: str):
-    try:
-        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{tempo_col} ON {quote_ident(table)} ({quote_ident(tempo_col)})")
-    except sqlite3.OperationalError:
-        pass
+def ensure_pragmas(conn: sqlite3.Connection, page_size: int = 0):
+    ensure_db_pragmas(conn, page_size)
+    ensure_conn_pragmas(conn)
+
+def has_fields(raw: str = "raw") -> str:
+    # righe con raw.fields array non vuoto: stesso predicato dell'indice
+    # parziale, da ripetere nelle WHERE perché SQLite lo scelga.
+    # json_valid prima delle funzioni json_*: su testo non JSON ('' compreso) darebbero
+    # "malformed JSON", e nell'indice farebbero fallire ogni INSERT/UPDATE di quella riga
+    return (f"CASE WHEN json_valid({raw}) THEN json_type({raw},'$.fields')='array' "
+            f"AND json_array_length({raw},'$.fields')>0 ELSE 0 END")
+
+def ensure_fields_index(conn: sqlite3.Connection, table: str) -> bool:
+    """Indice parziale sulle righe con fields, per le letture dell'expander.
+    Solo temporaneo (drop_fields_index a fine espansione): tenuto nel file, ogni
+    INSERT/UPDATE della tabella pagherebbe il parse JSON di raw.
+    False se table non ha raw."""
+    if 'raw' not in table_columns(conn, table):
+        return False
+    name = f'idx_{table}_has_fields'
+    sql = f"CREATE INDEX {quote_ident(name)} ON {quote_ident(table)} (json_valid(raw)) WHERE {has_fields()}"
     try:
-        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {quote_ident(table + '_ext_id_unique')} ON {quote_ident(table)} (ext_id)")
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type='index' AND name=?", (name,)).fetchone()
+        if row and row[0] != sql:
+            # versione precedente senza json_valid: va sostituita, bloccherebbe le scritture
+            conn.execute(f"DROP INDEX {quote_ident(name)}")
+            row = None
+        if not row:
+            conn.execute(sql)
     except sqlite3.OperationalError:
         pass
     conn.commit()
+    return True
+
+def drop_fields_index(conn: sqlite3.Connection, table: str):
+    conn.execute(f"DROP INDEX IF EXISTS {quote_ident(f'idx_{table}_has_fields')}")
+    conn.commit()
 
 def ensure_sync_table(conn: sqlite3.Connection):
     conn.execute(
@@ -51,7 +135,7 @@ CREATE TABLE IF NOT EXISTS memento_sync (
   library_id TEXT PRIMARY KEY,
   last_modified_remote TEXT,
   last_run_utc TEXT
-);
+) WITHOUT ROWID;
 """
 )
     conn.commit()
@@ -1,17 +1,38 @@
 \
 # v1
+import ast
 import re
 import sys
 from pathlib import Path
 
-def patch_file(path: Path) -> bool:
-    txt = path.read_text(encoding="utf-8", errors="replace")
+def _offset(txt: str, line_starts, lineno: int, col: int) -> int:
+    # ast: lineno 1-based, col_offset in byte UTF-8 sulla riga
+    start = line_starts[lineno - 1]
+    line = txt[start:line_starts[lineno]] if lineno < len(line_starts) else txt[start:]
+    return start + len(line.encode("utf-8")[:col].decode("utf-8", errors="ignore"))
+
+def _find_with_ast(txt: str):
+    """(start, end, indent, [(name, alias)]) del primo 'from memento_sdk import', o None."""
+    tree = ast.parse(txt)
+    node = next((n for n in ast.walk(tree)
+                 if isinstance(n, ast.ImportFrom) and n.module == "memento_sdk" and not n.level), None)
+    if node is None:
+        return None
+    line_starts = [0] + [m.end() for m in re.finditer(r"\r\n|\r|\n", txt)]
+    start = _offset(txt, line_starts, node.lineno, node.col_offset)
+    end = _offset(txt, line_starts, node.end_lineno, node.end_col_offset)
+    indent = txt[line_starts[node.lineno - 1]:start]
+    if indent.strip():
+        indent = ""  # es. "x = 1; from memento_sdk import ..."
+    names = [(a.name, a.asname or a.name) for a in node.names]
+    return start, end, indent, names
+
+def _find_with_regex(txt: str):
+    # fallback per file che non parsano (es. sintassi rotta altrove)
     m = re.search(r'^\s*from\s+memento_sdk\s+import\s*(\((?:.|\n)*?\)|[^\n]+)\s*$', txt, flags=re.M)
     if not m:
-        print("[INFO] Nessuna riga 'from memento_sdk import ...' trovata. Nulla da fare.")
-        return False
+        return None
 
-    import_block = m.group(0)
     inner = m.group(1)
 
     # Normalize to a list of names
@@ -25,20 +46,34 @@ def patch_file(path: Path) -> bool:
     parts = [p.strip() for p in re.split(r'[,\n]+', inside) if p.strip()]
     # Handle "name as alias"
     names = []
-    assigns = []
     for p in parts:
         if " as " in p:
             name, alias = [x.strip() for x in p.split(" as ", 1)]
         else:
             name, alias = p, p
         names.append((name, alias))
+    return m.start(), m.end(), "", names
 
+def patch_file(path: Path) -> bool:
+    txt = path.read_text(encoding="utf-8", errors="replace")
+    try:
+        found = _find_with_ast(txt)
+    except SyntaxError:
+        found = _find_with_regex(txt)
+    if not found:
+        print("[INFO] Nessuna riga 'from memento_sdk import ...' trovata. Nulla da fare.")
+        return False
+
+    start, end, indent, names = found
+    if any(name == "*" for name, _ in names):
+        print("[INFO] 'from memento_sdk import *' non gestito. Nulla da fare.")
+        return False
     repl_lines = ["import memento_sdk as _memento_sdk  # patched to avoid circular from-import"]
     for name, alias in names:
         repl_lines.append(f"{alias} = getattr(_memento_sdk, {name!r})")
-    repl = "\n".join(repl_lines)
+    repl = ("\n" + indent).join(repl_lines)
 
-    txt2 = txt.replace(import_block, repl, 1)
+    txt2 = txt[:start] + repl + txt[end:]
     path.write_text(txt2, encoding="utf-8")
     print(f"[OK] Patch applicata a: {path}")
     print("[OK] Ora elimina __pycache__ e rilancia lo script.")
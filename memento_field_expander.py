@@ -11,151 +11,287 @@
 #
 # Usage:
 #   python memento_field_expander.py noutput.db umore
+#   python memento_field_expander.py noutput.db umore 4   # 4 lettori in parallelo
 #   from memento_field_expander import expand_fields; expand_fields("noutput.db", "umore")
 #
 from __future__ import annotations
 
+import functools
+import json
+import queue
 import sqlite3
 import sys
-from typing import List, Tuple, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+try:
+    import orjson
+    _HAS_ORJSON = True
+except Exception:
+    _HAS_ORJSON = False
+
+from db_utils import drop_fields_index, ensure_fields_index, ensure_pragmas, has_fields, invalidate_schema, quote_ident, table_columns, table_exists
 
 TEXTY_TYPES = ('text','textarea','note','long_text','multiline')
 
+# SQLite >= 3.45: jsonb_each returns nested objects as JSONB, so the per-field
+# json_extract calls below don't reparse each field object from text.
+_JSON_EACH = 'jsonb_each' if sqlite3.sqlite_version_info >= (3, 45, 0) else 'json_each'
+
+# righe lette/scritte per pagina nel fill in Python
+_BATCH = 10_000
+
 def _log(s: str) -> None:
     print(s, flush=True)
 
 def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
-    row = conn.execute(
-        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
-        (table,)
-    ).fetchone()
-    return bool(row)
+    return table_exists(conn, table)
 
 def _has_raw_column(conn: sqlite3.Connection, table: str) -> bool:
-    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
-    return any(r[1].lower() == "raw" for r in rows)
+    return any(c.lower() == "raw" for c in table_columns(conn, table))
 
 def _list_current_columns(conn: sqlite3.Connection, table: str) -> List[str]:
-    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+    return list(table_columns(conn, table))
 
 def _discover_field_names_and_types(conn: sqlite3.Connection, table: str) -> List[Tuple[str,str]]:
+    # niente DISTINCT in SQL (b-tree temporaneo): si deduplica qui, in ordine
+    # di prima comparsa
     sql = f"""
-    SELECT DISTINCT
+    SELECT
       COALESCE(json_extract(j.value,'$.name'), '') AS field_name,
       COALESCE(json_extract(j.value,'$.type'), '') AS field_type
-    FROM {table} u,
-         json_each(json_extract(u.raw,'$.fields')) AS j
-    WHERE json_type(u.raw,'$.fields')='array'
+    FROM {quote_ident(table)} u,
+         {_JSON_EACH}(u.raw,'$.fields') AS j
+    WHERE {has_fields('u.raw')}
     """
-    out = []
+    seen: Dict[Tuple[str,str], None] = {}
     for name, ftype in conn.execute(sql):
         name = name or ''
         ftype = ftype or ''
         if name or ftype:
-            out.append((name, ftype))
-    return out
+            seen[(name, ftype)] = None
+    return list(seen)
 
-def _ensure_text_columns(conn: sqlite3.Connection, table: str, names: List[str]) -> List[str]:
+def _ensure_text_columns(conn: sqlite3.Connection, table: str, names: List[str], extras: Tuple[str, ...] = ()) -> List[str]:
     existing = set(_list_current_columns(conn, table))
-    created = []
-    for name in names:
-        if name in existing or not name:
-            continue
-        col = '"' + name.replace('"', '""') + '"'  # quote
-        conn.execute(f'ALTER TABLE {table} ADD COLUMN {col} TEXT')
-        created.append(name)
-    if created:
-        conn.commit()
-    return created
-
-def _fill_column_by_name(conn: sqlite3.Connection, table: str, field: str) -> Tuple[int,int]:
-    """Writes into column=field from the field with json name==field"""
-    if not field:
-        return (0,0)
-    col = '"' + field.replace('"','""') + '"'
-    sql_update = f"""
-    UPDATE {table}
-    SET {col} = (
-      SELECT json_extract(j.value, '$.value')
-      FROM json_each(json_extract({table}.raw,'$.fields')) AS j
-      WHERE json_extract(j.value,'$.name') = ?
-      LIMIT 1
-    )
-    WHERE ({col} IS NULL OR {col} = '')
-      AND EXISTS (
-        SELECT 1
-        FROM json_each(json_extract({table}.raw,'$.fields')) AS j2
-        WHERE json_extract(j2.value,'$.name') = ?
-          AND json_extract(j2.value,'$.value') IS NOT NULL
-          AND json_extract(j2.value,'$.value') <> ''
-      );
-    """
-    cur = conn.cursor()
-    cur.execute(sql_update, (field, field))
-    updated = cur.rowcount if cur.rowcount is not None else 0
+    missing = [n for n in dict.fromkeys(list(names) + list(extras)) if n and n not in existing]
+    if not missing:
+        return []
+    qt = quote_ident(table)
+    # nessun commit qui: le ALTER fanno parte della transazione di expand_fields
+    try:
+        for name in missing:
+            conn.execute(f'ALTER TABLE {qt} ADD COLUMN {quote_ident(name)} TEXT')
+    finally:
+        invalidate_schema(conn, table)
+    return missing
 
-    sql_filled = f"SELECT COUNT(*) FROM {table} WHERE {col} IS NOT NULL AND {col} <> ''"
-    already = conn.execute(sql_filled).fetchone()[0]
-    conn.commit()
-    return updated, already
+def _loads(raw) -> Any:
+    if _HAS_ORJSON:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass  # NaN/Infinity, interi oltre 64 bit, ...: li accetta solo json
+    return json.loads(raw)
 
-def _fill_column_by_type(conn: sqlite3.Connection, table: str, out_col: str, want_type: str, fallback_texty: bool=False) -> Tuple[int,int]:
-    """
-    Fill out_col from first field matching type=want_type.
-    If fallback_texty=True and want_type not found, pick first text-like type.
+def _loads_fields(raw) -> Optional[list]:
+    try:
+        d = _loads(raw)
+    except (TypeError, ValueError):
+        return None
+    fields = d.get('fields') if isinstance(d, dict) else None
+    return fields if isinstance(fields, list) else None
+
+def _sql_value(v: Any) -> Any:
+    # come json_extract: oggetti/array tornano testo JSON compatto
+    if isinstance(v, (dict, list)):
+        if _HAS_ORJSON:
+            try:
+                return orjson.dumps(v).decode('utf-8')
+            except TypeError:
+                pass
+        return json.dumps(v, ensure_ascii=False, separators=(',', ':'))
+    if type(v) is int and not -2**63 <= v < 2**63:
+        return float(v)
+    return v
+
+# SQL generato una volta per (tabella, colonne): le esecuzioni successive con lo
+# stesso schema riusano la stessa stringa (e lo statement già preparato)
+@functools.lru_cache(maxsize=64)
+def _scan_sql(table: str, cols: Tuple[str, ...], shard: Optional[Tuple[int, int]],
+              visible: Optional[FrozenSet[str]], batch: int) -> Tuple[str, str]:
+    qt = quote_ident(table)
+    sel = "".join(", " + (quote_ident(c) if visible is None or c in visible else "NULL") for c in cols)
+    # raw come bytes (CAST AS BLOB): json.loads li legge direttamente, senza
+    # passare dalla decodifica str del driver
+    head = f"SELECT rowid, CAST(raw AS BLOB){sel} FROM {qt} WHERE {has_fields()}"
+    if shard is not None:
+        head += f" AND rowid % {int(shard[1])} = {int(shard[0])}"
+    tail = f" ORDER BY rowid LIMIT {int(batch)}"
+    return head + tail, head + " AND rowid > ?" + tail
+
+@functools.lru_cache(maxsize=64)
+def _update_sql(table: str, cols: Tuple[str, ...]) -> str:
+    sets = ", ".join(f"{quote_ident(c)} = ?" for c in cols)
+    return f"UPDATE {quote_ident(table)} SET {sets} WHERE rowid = ?"
+
+def _scan_fields(conn: sqlite3.Connection, table: str, cols: List[str],
+                 shard: Optional[Tuple[int, int]] = None,
+                 visible: Optional[Set[str]] = None) -> Iterator[List[Tuple[int, list, tuple]]]:
+    """Pagine di (rowid, fields, valori attuali di cols), a blocchi di _BATCH righe.
+
+    raw è parsato una volta per riga con json.loads; keyset su rowid così le
+    UPDATE della pagina precedente non disturbano la lettura.
+    shard=(k, n) legge solo rowid % n = k; le colonne fuori da visible (non
+    ancora committate, quindi vuote) tornano NULL.
     """
-    col = '"' + out_col.replace('"','""') + '"'
-    types_list = "', '".join(TEXTY_TYPES)
-    # Prefer exact type first
-    sql_update_type = f"""
-    UPDATE {table}
-    SET {col} = (
-      SELECT json_extract(j.value, '$.value')
-      FROM json_each(json_extract({table}.raw,'$.fields')) AS j
-      WHERE json_extract(j.value,'$.type') = ?
-      LIMIT 1
-    )
-    WHERE ({col} IS NULL OR {col} = '')
-      AND EXISTS (
-        SELECT 1
-        FROM json_each(json_extract({table}.raw,'$.fields')) AS j2
-        WHERE json_extract(j2.value,'$.type') = ?
-          AND json_extract(j2.value,'$.value') IS NOT NULL
-          AND json_extract(j2.value,'$.value') <> ''
-      );
+    first, nxt = _scan_sql(table, tuple(cols), shard,
+                           None if visible is None else frozenset(visible), _BATCH)
+    rows = conn.execute(first).fetchall()
+    while rows:
+        page = []
+        for r in rows:
+            fields = _loads_fields(r[1])
+            if fields is not None:
+                page.append((r[0], fields, r[2:]))
+        yield page
+        rows = conn.execute(nxt, (rows[-1][0],)).fetchall()
+
+def _scan_shards(db_path: str, table: str, cols: List[str], visible: Set[str],
+                 workers: int) -> Iterator[List[Tuple[int, list, tuple]]]:
+    """Come _scan_fields, ma con workers connessioni read-only (una per shard
+    rowid % workers) in thread separati; le pagine arrivano qui, all'unico
+    writer. Richiede WAL: i lettori vedono lo stato committato prima del run."""
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    # coda limitata: i lettori si fermano se il writer resta indietro, invece di
+    # accumulare in memoria le righe parse di tutta la tabella
+    q: "queue.Queue[Any]" = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        # put con timeout: se il writer esce (stop) un lettore bloccato non resta appeso
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader(k: int) -> None:
+        try:
+            rc = sqlite3.connect(uri, uri=True)
+            try:
+                for page in _scan_fields(rc, table, cols, shard=(k, workers), visible=visible):
+                    if not put(page):
+                        break
+            finally:
+                rc.close()
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for k in range(workers):
+            ex.submit(reader, k)
+        try:
+            done = 0
+            while done < workers:
+                item = q.get()
+                if item is None:
+                    done += 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+def _empty(v: Any) -> bool:
+    return v is None or v == ''
+
+def _first_of_types(fields: list, prefs: Tuple[Tuple[str, ...], ...]) -> Any:
+    # primo valore non vuoto (in ordine di field) per il primo gruppo di tipi
+    # che ne ha uno
+    for types in prefs:
+        for f in fields:
+            if not isinstance(f, dict):
+                continue
+            t = f.get('type')
+            if isinstance(t, str) and t.lower() in types:
+                v = f.get('value')
+                if not _empty(v):
+                    return v
+    return None
+
+def _fill_columns(conn: sqlite3.Connection, table: str, names: List[str],
+                  by_type: Tuple[Tuple[str, Tuple[Tuple[str, ...], ...]], ...] = (),
+                  pages: Optional[Callable[[List[str]], Iterator[List[Tuple[int, list, tuple]]]]] = None) -> Tuple[int, Dict[str, int]]:
+    """Writes every column=field from the field with json name==field, in one pass.
+
+    Per riga prende il primo valore non vuoto di ogni name; poi, per ogni
+    (colonna, tipi) di by_type ancora vuota, il primo valore dei tipi in ordine
+    di preferenza. Riscrive solo le righe in cui qualcosa cambia.
+    Ritorna (righe aggiornate by-name, {colonna: righe aggiornate by-type}).
+    pages(cols) sostituisce la lettura seriale su conn (es. _scan_shards).
     """
-    cur = conn.cursor()
-    cur.execute(sql_update_type, (want_type, want_type))
-    updated = cur.rowcount if cur.rowcount is not None else 0
-
-    if fallback_texty and updated == 0:
-        sql_update_texty = f"""
-        UPDATE {table}
-        SET {col} = (
-          SELECT json_extract(j.value, '$.value')
-          FROM json_each(json_extract({table}.raw,'$.fields')) AS j
-          WHERE LOWER(COALESCE(json_extract(j.value,'$.type'),'')) IN ('{types_list}')
-          LIMIT 1
-        )
-        WHERE ({col} IS NULL OR {col} = '')
-          AND EXISTS (
-            SELECT 1
-            FROM json_each(json_extract({table}.raw,'$.fields')) AS j2
-            WHERE LOWER(COALESCE(json_extract(j2.value,'$.type'),'')) IN ('{types_list}')
-              AND json_extract(j2.value,'$.value') IS NOT NULL
-              AND json_extract(j2.value,'$.value') <> ''
-          );
-        """
-        cur.execute(sql_update_texty)
-        updated = cur.rowcount if cur.rowcount is not None else 0
-
-    sql_filled = f"SELECT COUNT(*) FROM {table} WHERE {col} IS NOT NULL AND {col} <> ''"
-    already = conn.execute(sql_filled).fetchone()[0]
-    conn.commit()
-    return updated, already
-
-def expand_fields(db_path: str, table: str) -> None:
-    conn = sqlite3.connect(db_path)
+    names = [n for n in dict.fromkeys(names) if n]
+    cols = names + [c for c, _ in by_type if c not in names]
+    typed = {c: 0 for c, _ in by_type}
+    if not cols:
+        return 0, typed
+    pos = {c: i for i, c in enumerate(cols)}
+    want = set(names)
+    sql_update = _update_sql(table, tuple(cols))
+    updated = 0
+    if pages is None:
+        pages = lambda cols: _scan_fields(conn, table, cols)
+    for page in pages(cols):
+        batch = []
+        for rid, fields, current in page:
+            found: Dict[str, Any] = {}
+            for f in fields:
+                if not isinstance(f, dict):
+                    continue
+                n = f.get('name')
+                if n in want and n not in found:
+                    v = f.get('value')
+                    if not _empty(v):
+                        found[n] = v
+            vals = list(current)
+            named = False
+            for n in found:
+                i = pos[n]
+                if _empty(vals[i]):
+                    vals[i] = _sql_value(found[n])
+                    named = True
+            changed = named
+            for col, prefs in by_type:
+                i = pos[col]
+                if not _empty(vals[i]):
+                    continue
+                v = _first_of_types(fields, prefs)
+                if v is not None:
+                    vals[i] = _sql_value(v)
+                    typed[col] += 1
+                    changed = True
+            if changed:
+                vals.append(rid)
+                batch.append(vals)
+            updated += named
+        if batch:
+            conn.executemany(sql_update, batch)
+    return updated, typed
+
+def expand_fields(db_path: str, table: str, workers: int = 1) -> None:
+    """workers > 1: parsing di raw su più connessioni read-only in parallelo
+    (solo DB su file in WAL; altrimenti seriale)."""
+    # autocommit del driver spento: la transazione la apriamo noi, una sola
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    ensure_pragmas(conn)
+    indexed = False
     try:
         if not _table_exists(conn, table):
             _log(f"[expander] Tabella '{table}' inesistente, skip.")
@@ -165,6 +301,16 @@ def expand_fields(db_path: str, table: str) -> None:
             return
 
         _log(f"[expander] Analisi tabella '{table}'...")
+        # indice sulle righe con fields solo per questa espansione (discovery + fill,
+        # e le letture per shard): lo toglie il finally
+        indexed = ensure_fields_index(conn, table)
+        parallel = (workers > 1 and db_path != ':memory:'
+                    and conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal')
+        # colonne già committate: le sole che i lettori paralleli possono vedere
+        visible = set(_list_current_columns(conn, table))
+
+        # un solo writer per tutto il lavoro: ALTER + UPDATE, un commit finale
+        conn.execute("BEGIN IMMEDIATE")
         nt = _discover_field_names_and_types(conn, table)
         names = [n for (n, t) in nt if n]
         type_summary: Dict[str,int] = {}
@@ -181,54 +327,63 @@ def expand_fields(db_path: str, table: str) -> None:
         if type_summary:
             _log(f"[expander] Tipi rilevati: " + ", ".join(f"{k}:{v}" for k,v in sorted(type_summary.items())))
 
-        # Create columns for exact names
-        created = _ensure_text_columns(conn, table, names)
-
-        # Special-case: ensure 'umore' and 'note' columns in table 'umore'
-        if table.lower() == 'umore':
-            existing = set(_list_current_columns(conn, table))
-            for extra in ('umore','note'):
-                if extra not in existing:
-                    conn.execute(f'ALTER TABLE {table} ADD COLUMN "{extra}" TEXT')
-                    created.append(extra)
-            conn.commit()
+        # Create columns for exact names (+ 'umore'/'note' in table 'umore')
+        extras = ('umore', 'note') if table.lower() == 'umore' else ()
+        created = _ensure_text_columns(conn, table, names, extras=extras)
 
         if created:
             _log(f"[expander] Create colonne: {', '.join(created)}")
         else:
             _log(f"[expander] Nessuna nuova colonna: schema già allineato.")
 
-        total_updated = 0
+        # statistiche aggiornate prima delle UPDATE pesanti
+        conn.execute("PRAGMA optimize")
 
-        # 1) Fill by exact name first
-        for nm in names:
-            updated, already = _fill_column_by_name(conn, table, nm)
-            total_updated += updated
-            if updated:
-                _log(f"[expander] by-name '{nm}': aggiornati {updated}")
+        total_updated = 0
 
-        # 2) For table 'umore': fill heuristics
+        # For table 'umore': umore/note prefer the field with that name; if
+        # still empty, first rating / first text (else any text-like) type.
+        by_type = ()
         if table.lower() == 'umore':
-            # umore: prefer name 'umore' (already done). If empty rows remain, fill first rating.
-            updated_u, already_u = _fill_column_by_type(conn, table, 'umore', 'rating', fallback_texty=False)
-            if updated_u:
-                _log(f"[expander] by-type 'umore'←rating: aggiornati {updated_u}")
-            # note: prefer name 'note' (already done). If empty rows remain, fill first text-like.
-            updated_n, already_n = _fill_column_by_type(conn, table, 'note', 'text', fallback_texty=True)
-            if updated_n:
-                _log(f"[expander] by-type 'note'←text-like: aggiornati {updated_n}")
+            by_type = (('umore', (('rating',),)),
+                       ('note', (('text',), TEXTY_TYPES)))
+
+        # by-name e by-type nella stessa passata su raw
+        pages = None
+        if parallel:
+            pages = lambda cols: _scan_shards(db_path, table, cols, visible, workers)
+        updated, typed = _fill_columns(conn, table, names, by_type, pages)
+        total_updated += updated
+        if updated:
+            _log(f"[expander] by-name: aggiornate {updated} righe")
+        if typed.get('umore'):
+            _log(f"[expander] by-type 'umore'←rating: aggiornati {typed['umore']}")
+        if typed.get('note'):
+            _log(f"[expander] by-type 'note'←text-like: aggiornati {typed['note']}")
+
+        conn.commit()
 
         _log(f"[expander] Completato: {table} → righe aggiornate totali {total_updated}.")
     finally:
+        if conn.in_transaction:
+            # uscita anticipata o errore: niente a metà
+            conn.rollback()
+        try:
+            if indexed:
+                drop_fields_index(conn, table)
+            conn.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
         conn.close()
 
 def main(argv: List[str]) -> int:
     if len(argv) < 2:
-        print("Uso: python memento_field_expander.py <db_path> <table>", flush=True)
+        print("Uso: python memento_field_expander.py <db_path> <table> [workers]", flush=True)
         return 2
     db_path = argv[0]
     table = argv[1]
-    expand_fields(db_path, table)
+    workers = int(argv[2]) if len(argv) > 2 else 1
+    expand_fields(db_path, table, workers)
     return 0
 
 if __name__ == "__main__":
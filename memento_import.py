@@ -4,57 +4,160 @@ import sys
 import time
 import sqlite3
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import json
+import logging
 import re
+import functools
 import io
 import zipfile
 import hashlib
 import random
 import shutil
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 
 from memento_sdk import (
     fetch_incremental_pages,
     fetch_all_entries_full,
 )
+from db_utils import ensure_pragmas
+
+try:
+    import orjson
+    _HAS_ORJSON = True
+except Exception:
+    _HAS_ORJSON = False
 
 # ---------------------------------------------------------------------
 # Logging helpers (timestamp everywhere)
 # ---------------------------------------------------------------------
 
-def ts() -> str:
-    return datetime.now().strftime("%H:%M:%S")
-
-def log(msg: str):
-    print(f"[{ts()}] {msg}")
-
-def log_error(msg: str):
-    print(f"[{ts()}] [ERRORE] {msg}")
+# un solo handler su stdout, timestamp dal Formatter; con argomenti %-style il
+# messaggio si formatta solo se il livello è abilitato
+class _SecondFormatter(logging.Formatter):
+    """asctime senza frazioni di secondo: strftime una volta per secondo, non per riga."""
+    _last = (None, "")
+
+    def formatTime(self, record, datefmt=None):
+        sec = int(record.created)
+        last = self._last  # tupla sostituita in blocco: lettura coerente anche tra thread
+        if last[0] != sec:
+            last = (sec, super().formatTime(record, datefmt))
+            self._last = last
+        return last[1]
+
+logger = logging.getLogger("memento_import")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(_SecondFormatter("[%(asctime)s] %(message)s", datefmt="%H:%M:%S"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def log(msg: str, *args):
+    logger.info(msg, *args)
+
+def log_error(msg: str, *args):
+    logger.error("[ERRORE] " + msg, *args)
 
 # ---------------------------------------------------------------------
 # Utility
 # ---------------------------------------------------------------------
 
+def _dumps_raw(o: Any) -> str:
+    """JSON compatto per raw_json: orjson se disponibile, altrimenti json."""
+    if _HAS_ORJSON:
+        try:
+            return orjson.dumps(o).decode("utf-8")
+        except TypeError:
+            pass  # chiavi non stringa, int oltre 64 bit, ...
+    return json.dumps(o, ensure_ascii=False)
+
+_PREFETCH_DONE = object()
+
+def _mark_last(it):
+    """(item, is_last): guarda un elemento avanti, prima di restituire quello corrente."""
+    it = iter(it)
+    cur = next(it, _PREFETCH_DONE)
+    while cur is not _PREFETCH_DONE:
+        nxt = next(it, _PREFETCH_DONE)
+        yield cur, nxt is _PREFETCH_DONE
+        cur = nxt
+
+def _prefetch(it, maxsize: int = 4):
+    """Consuma l'iteratore `it` in un thread, con al più maxsize elementi in coda:
+    il download della pagina successiva si sovrappone all'insert di quella corrente.
+    Le eccezioni del produttore si rialzano nel consumatore."""
+    q: "queue.Queue" = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run():
+        try:
+            for x in it:
+                if not _put((x, None)):
+                    return
+            _put((_PREFETCH_DONE, None))
+        except BaseException as ex:
+            _put((_PREFETCH_DONE, ex))
+        finally:
+            close = getattr(it, "close", None)
+            if close:
+                close()
+
+    t = threading.Thread(target=_run, name="memento-prefetch", daemon=True)
+    t.start()
+    try:
+        while True:
+            x, err = q.get()
+            if x is _PREFETCH_DONE:
+                if err is not None:
+                    raise err
+                return
+            yield x
+    finally:
+        # consumatore uscito (anche per errore): il produttore si ferma alla prossima put
+        stop.set()
+        t.join()
+
 def flatten_entries(entries: Any) -> List[Dict]:
     """
     Normalizza payload API:
     - dict -> [dict]
-    - list di dict -> ok
-    - list annidate -> flatten
+    - list di dict -> ok (la lista stessa, senza copia)
+    - list annidate -> flatten (iterativo, nessun limite di ricorsione)
     """
-    out = []
+    if isinstance(entries, dict):
+        return [entries]
+    if not isinstance(entries, list):
+        return []  # forma sconosciuta, ignora
+    if all(isinstance(y, dict) for y in entries):
+        return entries
 
-    def _walk(x):
-        if isinstance(x, dict):
-            out.append(x)
-        elif isinstance(x, list):
-            for y in x:
-                _walk(y)
+    out = []
+    # pila di iteratori: mantiene l'ordine originale degli elementi
+    stack = [iter(entries)]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, dict):
+                out.append(x)
+            elif isinstance(x, list):
+                stack.append(iter(x))
+                break
+            # altre forme: ignorate
         else:
-            # forma sconosciuta, ignora
-            pass
-
-    _walk(entries)
+            stack.pop()
     return out
 
 # ---------------------------------------------------------------------
@@ -63,30 +166,29 @@ def flatten_entries(entries: Any) -> List[Dict]:
 
 def ensure_sync_state_table(conn) -> None:
     """Crea la tabella di checkpoint per gli import incremental (se manca).
-    Mantiene uno stato per library_id -> last_modified_remote."""
-    cur = conn.cursor()
-    cur.execute(
+    Mantiene uno stato per library_id -> last_modified_remote.
+    WITHOUT ROWID: la riga sta nel B-tree della chiave, lookup senza passare dall'indice
+    (vale solo per le tabelle nuove; quelle esistenti restano come sono).
+    Non fa commit: lo fa il chiamante."""
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS memento_sync (
             library_id TEXT PRIMARY KEY,
             last_modified_remote TEXT
-        )
+        ) WITHOUT ROWID
         """
     )
-    conn.commit()
 
 def load_sync_state(conn, library_id: str):
-    cur = conn.cursor()
-    cur.execute(
+    row = conn.execute(
         "SELECT last_modified_remote FROM memento_sync WHERE library_id=?",
         (library_id,),
-    )
-    row = cur.fetchone()
+    ).fetchone()
     return row[0] if row else None
 
 def save_sync_state(conn, library_id: str, last_modified_remote: str):
-    cur = conn.cursor()
-    cur.execute(
+    """Scrive il checkpoint nella transazione corrente (commit a carico del chiamante)."""
+    conn.execute(
         """
         INSERT INTO memento_sync (library_id, last_modified_remote)
         VALUES (?, ?)
@@ -95,17 +197,18 @@ def save_sync_state(conn, library_id: str, last_modified_remote: str):
         """,
         (library_id, last_modified_remote),
     )
-    conn.commit()
-    log(f"✓ Checkpoint scritto: {last_modified_remote}")
+    log("✓ Checkpoint scritto: %s", last_modified_remote)
 
 # ---------------------------------------------------------------------
 # Import core
 # ---------------------------------------------------------------------
 
 
+_NORMALIZE_KEY_RE = re.compile(r"[\s\._-]+")
+
+@functools.lru_cache(maxsize=4096)
 def _normalize_key(s: str) -> str:
-    import re
-    return re.sub(r"[\s\._-]+", "", str(s).strip().lower())
+    return _NORMALIZE_KEY_RE.sub("", str(s).strip().lower())
 
 
 def _find_csv_zip(search_dir: str) -> str:
@@ -113,6 +216,10 @@ def _find_csv_zip(search_dir: str) -> str:
     return p if os.path.exists(p) else ""
 
 
+# enrich_autodetect.json e l'INI batch sono read-modify-write condivisi tra sezioni
+_PERSIST_LOCK = threading.Lock()
+
+
 def _load_autodetect_cache(cache_path: str) -> Dict[str, Any]:
     try:
         with open(cache_path, "r", encoding="utf-8") as f:
@@ -131,6 +238,8 @@ def _save_autodetect_cache(cache_path: str, data: Dict[str, Any]) -> None:
         pass
 
 
+_ENRICH_LINE_RE = re.compile(r"(?mi)^\s*enrich_details\s*=\s*.*$")
+
 def _persist_ini_enrich_details(ini_path: str, section: str, value: bool) -> None:
     """
     Aggiorna/aggiunge la riga 'enrich_details=...' SOLO nella sezione target,
@@ -161,9 +270,8 @@ def _persist_ini_enrich_details(ini_path: str, section: str, value: bool) -> Non
         new_line = f"enrich_details={'true' if value else 'false'}"
 
         # Replace if present, otherwise insert after section header
-        if re.search(r"(?mi)^\s*enrich_details\s*=", body):
-            body2 = re.sub(r"(?mi)^\s*enrich_details\s*=\s*.*$", new_line, body)
-        else:
+        body2, n = _ENRICH_LINE_RE.subn(new_line, body)
+        if not n:
             # insert at end of block body (before next section)
             body2 = body.rstrip() + "\n" + new_line + "\n"
 
@@ -178,26 +286,73 @@ def _persist_ini_enrich_details(ini_path: str, section: str, value: bool) -> Non
         pass
 
 
-def _open_csv_from_zip(zip_path: str, member: str) -> List[List[str]]:
+def _open_csv_from_zip(zip_path: str, member: str, encoding: str = "utf-8-sig") -> Iterator[List[str]]:
+    """Righe non vuote del CSV, lette in streaming dal membro dello zip (niente file intero in RAM).
+    Un byte non valido per `encoding` solleva UnicodeDecodeError a metà lettura: il chiamante
+    ricomincia con un'altra codifica."""
     import csv as _csv
-    with zipfile.ZipFile(zip_path, "r") as z:
-        raw = z.read(member)
-    # Decode robustly
-    for enc in ("utf-8-sig", "utf-8", "latin-1"):
+    with zipfile.ZipFile(zip_path, "r") as z, z.open(member) as raw:
+        text = io.TextIOWrapper(raw, encoding=encoding, newline="")
+        # Sniff delimiter (primi 4 KiB; la riga tagliata si completa prima di ripartire)
+        sample = text.read(4096)
         try:
-            s = raw.decode(enc)
-            break
+            dialect = _csv.Sniffer().sniff(sample, delimiters=",;\t")
+            delim = dialect.delimiter
         except Exception:
-            s = raw.decode("utf-8", errors="replace")
-    # Sniff delimiter
-    sample = s[:4096]
+            delim = ","
+        head = io.StringIO(sample + text.readline())
+        for row in _csv.reader(chain(head, text), delimiter=delim):
+            if row:
+                yield row
+
+
+def _scan_csv_sample(zip_path: str, member: str, encoding: str, k: int = 30):
+    """(headers, pk, campione): prime k righe + k a caso su tutte, in una passata.
+    Reservoir (algoritmo R): memoria costante anche per CSV enormi. Senza pk il
+    campione non serve e del file si legge solo l'header."""
+    rows = _open_csv_from_zip(zip_path, member, encoding)
     try:
-        dialect = _csv.Sniffer().sniff(sample, delimiters=",;\t")
-        delim = dialect.delimiter
-    except Exception:
-        delim = ","
-    reader = _csv.reader(io.StringIO(s), delimiter=delim)
-    return [row for row in reader if row]
+        headers = next(rows, None)
+        if not headers:
+            return [], "", []
+
+        # infer pk
+        pk = ""
+        for h in headers:
+            hl = _normalize_key(h)
+            if hl in ("id", "entryid", "entry_id", "mementoid", "memento_id"):
+                pk = h
+                break
+        if not pk:
+            return headers, "", []
+
+        head = list(islice(rows, k))
+        reservoir = list(head)
+        n = len(head)
+        randrange = random.randrange
+        for r in rows:
+            j = randrange(n + 1)
+            if j < k:
+                reservoir[j] = r
+            n += 1
+        # con al più k righe il campione casuale coinciderebbe con la testa
+        return headers, pk, head + reservoir if n > k else head
+    finally:
+        rows.close()
+
+
+@functools.lru_cache(maxsize=8)
+def _csv_member_index(zip_path: str, mtime_ns: int, size: int):
+    """(membri .csv, indice normalizzato stem -> membro) dello zip; mtime_ns/size solo come chiave."""
+    with zipfile.ZipFile(zip_path, "r") as z:
+        members = tuple(n for n in z.namelist() if n.lower().endswith(".csv"))
+
+    # Build normalized index
+    idx = {}
+    for n in members:
+        stem = os.path.basename(n)[:-4]
+        idx[_normalize_key(stem)] = n
+    return members, idx
 
 
 def _load_csv_header_and_sample(zip_path: str, section: str, table: str, library_id: str) -> Dict[str, Any]:
@@ -208,15 +363,20 @@ def _load_csv_header_and_sample(zip_path: str, section: str, table: str, library
       - pk (colonna id se trovata)
       - sample_by_id (dict id -> rowdict) se pk trovato
       - signature (hash header)
+    Memoizzato per zip (path, mtime, size): autodetect e import della stessa sezione
+    leggono il CSV una volta sola.
     """
-    with zipfile.ZipFile(zip_path, "r") as z:
-        members = [n for n in z.namelist() if n.lower().endswith(".csv")]
+    zip_path = os.path.abspath(zip_path)
+    st = os.stat(zip_path)
+    info = _csv_header_and_sample_cached(zip_path, st.st_mtime_ns, st.st_size, section, table, library_id)
+    # headers come lista nuova: il chiamante può modificarla senza toccare la cache
+    return dict(info, headers=list(info["headers"]))
 
-    # Build normalized index
-    idx = {}
-    for n in members:
-        stem = os.path.basename(n)[:-4]
-        idx[_normalize_key(stem)] = n
+
+@functools.lru_cache(maxsize=64)
+def _csv_header_and_sample_cached(zip_path: str, mtime_ns: int, size: int,
+                                  section: str, table: str, library_id: str) -> Dict[str, Any]:
+    members, idx = _csv_member_index(zip_path, mtime_ns, size)
 
     key_candidates = [
         _normalize_key(table),
@@ -246,28 +406,20 @@ def _load_csv_header_and_sample(zip_path: str, section: str, table: str, library
     if not member:
         return {"member": "", "headers": [], "pk": "", "sample_by_id": {}, "signature": ""}
 
-    rows = _open_csv_from_zip(zip_path, member)
-    if not rows:
+    # Decode robustly: UTF-8 (con o senza BOM), altrimenti latin-1 (non fallisce mai)
+    for enc in ("utf-8-sig", "latin-1"):
+        try:
+            headers, pk, sample = _scan_csv_sample(zip_path, member, enc)
+            break
+        except UnicodeDecodeError:
+            continue
+    if not headers:
         return {"member": member, "headers": [], "pk": "", "sample_by_id": {}, "signature": ""}
 
-    headers = rows[0]
     sig = hashlib.sha1(("|".join(headers)).encode("utf-8", errors="ignore")).hexdigest()[:12]
 
-    # infer pk
-    pk = ""
-    for h in headers:
-        hl = _normalize_key(h)
-        if hl in ("id", "entryid", "entry_id", "mementoid", "memento_id"):
-            pk = h
-            break
-
     sample_by_id = {}
     if pk:
-        # sample first 30 + up to 30 random
-        data_rows = rows[1:]
-        head = data_rows[:30]
-        tail = random.sample(data_rows, k=min(30, len(data_rows))) if len(data_rows) > 30 else []
-        sample = head + tail
         pk_idx = headers.index(pk)
         for r in sample:
             if pk_idx < len(r):
@@ -278,7 +430,8 @@ def _load_csv_header_and_sample(zip_path: str, section: str, table: str, library
     return {"member": member, "headers": headers, "pk": pk, "sample_by_id": sample_by_id, "signature": sig}
 
 
-def _ensure_table_schema(conn, table: str, headers: List[str], pk: str) -> None:
+def _ensure_table_schema(conn, table: str, headers: List[str], pk: str) -> str:
+    """Crea/allinea la tabella; ritorna la colonna chiave garantita unica ("" se nessuna)."""
     cur = conn.cursor()
     # create if missing
     cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
@@ -293,20 +446,76 @@ def _ensure_table_schema(conn, table: str, headers: List[str], pk: str) -> None:
             else:
                 col_defs.append(f'"{c}" TEXT')
         cur.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({", ".join(col_defs)})')
-        conn.commit()
-        return
-
-    # alter missing columns
-    cur.execute(f'PRAGMA table_info("{table}")')
-    existing = {r[1] for r in cur.fetchall()}  # name at index 1
-    for c in cols:
-        if c not in existing:
-            cur.execute(f'ALTER TABLE "{table}" ADD COLUMN "{c}" TEXT')
+    else:
+        # alter missing columns
+        cur.execute(f'PRAGMA table_info("{table}")')
+        existing = {r[1] for r in cur.fetchall()}  # name at index 1
+        for c in cols:
+            if c not in existing:
+                cur.execute(f'ALTER TABLE "{table}" ADD COLUMN "{c}" TEXT')
+
+    # senza PRIMARY KEY (schema di fallback, o tabella nata così) l'upsert non ha
+    # un conflitto su cui agire: indice UNIQUE sull'id, se i dati già presenti lo permettono
+    key = pk or ("id" if "id" in headers else "")
+    if not key or (not exists and key == pk) or _has_unique_key(cur, table, key):
+        return key
+    failed = (cur.execute("PRAGMA database_list").fetchone()[2], table, key)
+    if failed in _UNIQUE_FAILED:
+        return ""  # già tentato in questo processo: niente nuova scansione della tabella
+    try:
+        cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table}_{key}_unique" ON "{table}" ("{key}")')
+    except sqlite3.IntegrityError:
+        _UNIQUE_FAILED.add(failed)
+        log("[schema] %s.%s non univoco: niente indice UNIQUE, INSERT senza upsert", table, key)
+        return ""  # id duplicati da import precedenti: si lascia la tabella com'è
+    log("[schema] %s: creato indice UNIQUE %s_%s_unique su %s (serve all'upsert)", table, table, key, key)
+    return key
+
+
+# (file db, tabella, chiave) dove l'indice UNIQUE è fallito per id duplicati
+_UNIQUE_FAILED = set()
+
+def _has_unique_key(cur, table: str, key: str) -> bool:
+    """PRIMARY KEY o indice UNIQUE (non parziale) esattamente su `key`."""
+    if [r[1] for r in cur.execute(f'PRAGMA table_info("{table}")').fetchall() if r[5]] == [key]:
+        return True
+    for r in cur.execute(f'PRAGMA index_list("{table}")').fetchall():
+        if r[2] and not r[4]:
+            name = r[1].replace('"', '""')
+            if [c[2] for c in cur.execute(f'PRAGMA index_info("{name}")').fetchall()] == [key]:
+                return True
+    return False
+
+
+def _drop_secondary_indexes(conn, table: str) -> List[str]:
+    """DROP degli indici non UNIQUE della tabella; ritorna i CREATE per ricrearli a fine import.
+    Gli UNIQUE restano: servono all'upsert (ON CONFLICT) e al controllo dei duplicati."""
+    unique = {r[1] for r in conn.execute(f'PRAGMA index_list("{table}")') if r[2]}
+    saved = []
+    for name, sql in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+        (table,),
+    ).fetchall():
+        if name in unique:
+            continue
+        conn.execute('DROP INDEX "{}"'.format(name.replace('"', '""')))
+        saved.append(sql)
+    conn.commit()
+    return saved
+
+def _restore_indexes(conn, saved: List[str]) -> None:
+    # un CREATE INDEX a tabella piena: un ordinamento invece di un aggiornamento per riga
+    for sql in saved:
+        conn.execute(sql)
     conn.commit()
 
 
+_NORM_KEY_RE = re.compile(r"[^a-z0-9]+")
+
+# chiamata per ogni header e ogni etichetta di ogni entry: pochi valori distinti
+@functools.lru_cache(maxsize=4096)
 def _norm_key(k: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (k or "").strip().lower())
+    return _NORM_KEY_RE.sub("", (k or "").strip().lower())
 
 def _collect_fields(entry: Any) -> Dict[str, Any]:
     """Extract a best-effort {label/name -> value} map from a Memento entry detail."""
@@ -360,27 +569,46 @@ def _collect_fields(entry: Any) -> Dict[str, Any]:
 
     return out
 
-def _entry_to_row(entry: Dict[str, Any], headers: List[str]) -> Dict[str, str]:
+@functools.lru_cache(maxsize=64)
+def _header_plan(headers: Tuple[str, ...]):
+    """((header, header normalizzato), ...) + insieme dei normalizzati: una volta per schema."""
+    steps = tuple((h, _norm_key(h)) for h in headers)
+    return steps, frozenset(hn for _, hn in steps)
+
+def _header_values(entry: Dict[str, Any], headers: List[str], plan=None) -> List[str]:
+    """Valori (stringhe) di `entry` nell'ordine di `headers`."""
+    steps, wanted = plan or _header_plan(tuple(headers))
     fields_raw = _collect_fields(entry)
-    fields_norm = {_norm_key(k): v for k, v in fields_raw.items()}
+    fields_norm = None  # solo se qualche header non ha la corrispondenza esatta
+    is_dict = isinstance(entry, dict)
 
-    out: Dict[str, str] = {}
-    for h in headers:
+    out: List[str] = []
+    append = out.append
+    for h, hn in steps:
         v = None
         # exact label match
         if h in fields_raw:
-            v = fields_raw.get(h)
+            v = fields_raw[h]
         else:
-            hn = _norm_key(h)
+            if fields_norm is None:
+                # solo le etichette che possono corrispondere a un header (a parità, vince l'ultima)
+                fields_norm = {}
+                for k, fv in fields_raw.items():
+                    kn = _norm_key(k)
+                    if kn in wanted:
+                        fields_norm[kn] = fv
             if hn in fields_norm:
-                v = fields_norm.get(hn)
-            elif isinstance(entry, dict) and h in entry:
-                v = entry.get(h)
-            elif isinstance(entry, dict) and hn == "extid" and "id" in entry:
-                v = entry.get("id")
-        out[h] = "" if v is None else str(v)
-
-    out["raw_json"] = json.dumps(entry, ensure_ascii=False)
+                v = fields_norm[hn]
+            elif is_dict and h in entry:
+                v = entry[h]
+            elif is_dict and hn == "extid" and "id" in entry:
+                v = entry["id"]
+        append("" if v is None else str(v))
+    return out
+
+def _entry_to_row(entry: Dict[str, Any], headers: List[str]) -> Dict[str, str]:
+    out: Dict[str, str] = dict(zip(headers, _header_values(entry, headers)))
+    out["raw_json"] = _dumps_raw(entry)
     return out
 
 
@@ -394,6 +622,27 @@ def _rows_match(csv_row: Dict[str, str], api_row: Dict[str, str], headers: List[
     return True
 
 
+def _sample_matches(probed: List[Dict], pk: str, sample_by_id: Dict[str, Dict[str, str]], headers: List[str]):
+    """(ok, bad) sulle prime 12 entry del probe che compaiono nel campione CSV."""
+    ok = 0
+    bad = 0
+    for e in probed:
+        rid = str(e.get("id") or e.get(pk) or "").strip()
+        if not rid:
+            continue
+        csv_row = sample_by_id.get(rid)
+        if not csv_row:
+            continue
+        api_row = _entry_to_row(e, headers)
+        if _rows_match(csv_row, api_row, headers):
+            ok += 1
+        else:
+            bad += 1
+        if ok + bad >= 12:
+            break
+    return ok, bad
+
+
 def _autodetect_enrich_details(
     *,
     base_dir: str,
@@ -428,13 +677,21 @@ def _autodetect_enrich_details(
     if isinstance(c, dict) and c.get("signature") == signature and isinstance(c.get("enrich_details"), bool):
         return {"decided": True, "enrich_details": bool(c["enrich_details"]), "reason": "cache"}
 
+    def _needs_more(probed: List[Dict]) -> bool:
+        # la seconda pagina serve solo se la prima lascia aperto il confronto col CSV
+        fields = probed[0].get("fields")
+        if not isinstance(fields, dict) or not fields or not (pk and sample_by_id):
+            return False
+        ok, bad = _sample_matches(probed, pk, sample_by_id, headers)
+        return bad == 0 and ok + bad < 12
+
     # Quick probe: fetch 1-2 pages WITHOUT details
     probed = []
     try:
         for page_i, chunk in enumerate(fetch_incremental_pages(library_id, limit=limit, enrich_details=False), start=1):
             if isinstance(chunk, list):
                 probed.extend([e for e in chunk if isinstance(e, dict)])
-            if page_i >= 2:
+            if page_i >= 2 or (probed and not _needs_more(probed)):
                 break
     except Exception as ex:
         # If probe fails, don't decide automatically
@@ -456,22 +713,7 @@ def _autodetect_enrich_details(
         enrich = False
         reason = "list_match"
         if pk and sample_by_id:
-            ok = 0
-            bad = 0
-            for e in probed:
-                rid = str(e.get("id") or e.get(pk) or "").strip()
-                if not rid:
-                    continue
-                csv_row = sample_by_id.get(rid)
-                if not csv_row:
-                    continue
-                api_row = _entry_to_row(e, headers)
-                if _rows_match(csv_row, api_row, headers):
-                    ok += 1
-                else:
-                    bad += 1
-                if ok + bad >= 12:
-                    break
+            ok, bad = _sample_matches(probed, pk, sample_by_id, headers)
             if bad > 0:
                 enrich = True
                 reason = "list_mismatch_sample"
@@ -490,18 +732,20 @@ def _autodetect_enrich_details(
                 enrich = True
                 reason = f"low_field_coverage:{ratio:.2f}"
 
-    # persist
-    cache[section] = {
-        "enrich_details": bool(enrich),
-        "signature": signature,
-        "decided_at": datetime.now().isoformat(timespec="seconds"),
-        "reason": reason,
-        "csv_member": csvinfo.get("member") or "",
-    }
-    _save_autodetect_cache(cache_path, cache)
-
-    if ini_path:
-        _persist_ini_enrich_details(ini_path, section, bool(enrich))
+    # persist (sezioni in parallelo: rilettura + scrittura sotto lock, niente aggiornamenti persi)
+    with _PERSIST_LOCK:
+        cache = _load_autodetect_cache(cache_path)
+        cache[section] = {
+            "enrich_details": bool(enrich),
+            "signature": signature,
+            "decided_at": datetime.now().isoformat(timespec="seconds"),
+            "reason": reason,
+            "csv_member": csvinfo.get("member") or "",
+        }
+        _save_autodetect_cache(cache_path, cache)
+
+        if ini_path:
+            _persist_ini_enrich_details(ini_path, section, bool(enrich))
 
     return {"decided": True, "enrich_details": bool(enrich), "reason": reason}
 
@@ -515,11 +759,20 @@ def import_library_incremental(
     base_dir: str = "",
     ini_path: str = "",
     section: str = "",
+    prefetch: int = 4,
+    commit_pages: int = 1,
+    defer_indexes: bool = False,
+    store_raw_json: bool = True,
 ):
     """
     Import incremental:
-    - commit per pagina (no più tutto-o-niente)
+    - una transazione ogni `commit_pages` pagine (0 = una sola per tutta la sezione);
+      checkpoint a fine sezione
+    - fino a `prefetch` pagine scaricate in anticipo da un thread (0 = sequenziale)
+    - defer_indexes: indici secondari tolti durante l'import e ricreati alla fine
     - schema = colonne CSV (se disponibili) + raw_json
+    - store_raw_json=False: raw_json non si scrive (resta quello già salvato); ignorato
+      senza CSV, quando raw_json è l'unico contenuto delle righe
     - autodetect enrich_details (solo primo run) se memento_all_csv.zip è presente
     """
     ensure_sync_state_table(conn)
@@ -537,7 +790,7 @@ def import_library_incremental(
             )
             if det.get("decided"):
                 enrich_details = bool(det.get("enrich_details"))
-                log(f"[autodetect] {section}: enrich_details={enrich_details} reason={det.get('reason')}")
+                log("[autodetect] %s: enrich_details=%s reason=%s", section, enrich_details, det.get("reason"))
         except Exception:
             pass
 
@@ -557,125 +810,207 @@ def import_library_incremental(
     if not headers:
         # Fallback minimal schema
         headers = ["id", "modified"]
+        store_raw_json = True
 
-    _ensure_table_schema(conn, table, headers, pk)
+    key = _ensure_table_schema(conn, table, headers, pk)
+    conn.commit()
+    deferred = _drop_secondary_indexes(conn, table) if defer_indexes else []
 
     last_modified_remote = load_sync_state(conn, library_id)
     if last_modified_remote:
-        log(f"Checkpoint precedente (last_modified_remote): {last_modified_remote}")
+        log("Checkpoint precedente (last_modified_remote): %s", last_modified_remote)
     else:
         log("Checkpoint precedente (last_modified_remote): — nessuno —")
 
     inserted = 0
     page_no = 0
-
-    def _insert_chunk(chunk: List[Dict[str, Any]]):
-        """Inserisce una pagina (chunk) in modo atomico.
+    section_max = None
+
+    # colonne e statement: una volta per sezione, uguali per tutte le pagine
+    cols = headers + ["raw_json"] if store_raw_json else list(headers)
+    placeholders = ", ".join(["?"] * len(cols))
+    col_sql = ", ".join([f'"{c}"' for c in cols])
+    sql = f'INSERT INTO "{table}" ({col_sql}) VALUES ({placeholders})'
+    if key:
+        # UPSERT: aggiorna la riga sul posto (stesso rowid, colonne extra intatte)
+        # invece di DELETE + INSERT come faceva INSERT OR REPLACE
+        sets = ", ".join(f'"{c}"=excluded."{c}"' for c in cols if c != key)
+        # solo la chiave (CSV con il solo id, senza raw_json): niente da aggiornare
+        sql += f' ON CONFLICT("{key}") ' + (f"DO UPDATE SET {sets}" if sets else "DO NOTHING")
+    cur = conn.cursor()  # uno per sezione, riusato da ogni pagina
+    plan = _header_plan(tuple(headers))  # risoluzione degli header: una volta per sezione
+
+    def _insert_chunk(chunk: List[Dict[str, Any]]) -> Any:
+        """Inserisce una pagina (chunk) nella transazione aperta dal chiamante.
         Se enrich_details=True e il mapping produce righe vuote (tutte colonne CSV vuote), interrompe subito.
+        Ritorna il 'modified' più recente della pagina, raccolto nello stesso passaggio.
         """
-        cur = conn.cursor()
-        cols = headers + ["raw_json"]
-        placeholders = ", ".join(["?"] * len(cols))
-        col_sql = ", ".join([f'"{c}"' for c in cols])
-        sql = f'INSERT OR REPLACE INTO "{table}" ({col_sql}) VALUES ({placeholders})'
+        last_mod = None
 
-        conn.execute("SAVEPOINT memento_page")
-        try:
-            vals = []
+        def _params(_values=_header_values, _plan=plan, _dumps=_dumps_raw if store_raw_json else None,
+                    _check=enrich_details):
+            nonlocal last_mod
+            # executemany consuma le tuple una alla volta: niente lista intermedia
             for e in chunk:
-                row = _entry_to_row(e, headers)
-
-                if enrich_details:
+                if isinstance(e, dict):
+                    # stesso timestamp con nomi diversi a seconda della versione API
+                    m = e.get("modified") or e.get("modifiedTime") or e.get("updatedTime")
+                    # ISO 8601 UTC dall'API: il confronto tra stringhe segue l'ordine temporale
+                    if m and (last_mod is None or m > last_mod):
+                        last_mod = m
+                # tupla posizionale (headers + raw_json) senza passare da un dict per riga
+                vals = _values(e, headers, _plan)
+
+                if _check:
                     # Fail-fast: non ha senso continuare a scrivere righe vuote fino alla fine
-                    has_any = False
-                    for h in headers:
-                        vv = row.get(h, "")
-                        if vv is None:
-                            vv = ""
-                        if str(vv).strip() != "":
-                            has_any = True
-                            break
-                    if not has_any:
+                    if not any(v.strip() for v in vals):
                         raise RuntimeError("fields vuoti dopo enrichment")
 
-                vals.append([row.get(c, "") for c in cols])
+                if _dumps is not None:
+                    vals.append(_dumps(e))
+                yield tuple(vals)
 
-            cur.executemany(sql, vals)
-            conn.execute("RELEASE SAVEPOINT memento_page")
-        except Exception:
-            conn.execute("ROLLBACK TO SAVEPOINT memento_page")
-            conn.execute("RELEASE SAVEPOINT memento_page")
-            raise
+        cur.executemany(sql, _params())
+        return last_mod
 
     t0 = time.time()
-    for chunk in fetch_incremental_pages(
+    pages = fetch_incremental_pages(
         library_id,
         modified_after_iso=last_modified_remote,
         limit=limit,
         enrich_details=enrich_details,
-        progress=lambda ev: log(f"[incremental] Progress: {ev}") if isinstance(ev, dict) and "rows" in ev else None,
-    ):
-        if not chunk:
-            continue
-        page_no += 1
-        _insert_chunk(chunk)
+        progress=lambda ev: log("[incremental] Progress: %s", ev) if isinstance(ev, dict) and "rows" in ev else None,
+    )
+    if prefetch > 0:
+        pages = _prefetch(pages, prefetch)
+    # commit ogni `commit_pages` pagine: meno commit, ma un errore annulla tutte le pagine
+    # della transazione aperta, e il lock di scrittura resta preso più a lungo
+    pending = 0
+    try:
+        # la pagina successiva si attende prima di aprire la transazione (con prefetch di
+        # solito è già in coda): così l'ultima pagina si riconosce senza tenere il lock
+        for chunk, is_last in _mark_last(pages):
+            if not chunk:
+                continue
+            page_no += 1
+
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            last_mod = _insert_chunk(chunk)
+            pending += 1
+            # ultima pagina: niente commit qui, esce col checkpoint (import piccoli: un commit solo)
+            if commit_pages and pending >= commit_pages and not is_last:
+                conn.commit()
+                pending = 0
+            inserted += len(chunk)
+            if last_mod and (section_max is None or last_mod > section_max):
+                section_max = last_mod
+
+            dt = time.time() - t0
+            log("Pagina %d: +%d righe (tot=%d) — %.3fs", page_no, len(chunk), inserted, dt)
+
+        # checkpoint una volta sola, a sezione completa: il massimo di una pagina intermedia
+        # salterebbe le entry più vecchie delle pagine successive se il feed non è ordinato.
+        # Un'interruzione a metà ripete le pagine già scritte (upsert: idempotente).
+        # Va nella transazione ancora aperta, se c'è: stesso commit delle ultime pagine.
+        if section_max:
+            save_sync_state(conn, library_id, section_max)
         conn.commit()
-        inserted += len(chunk)
-
-        # checkpoint after commit
-        last_mod = None
-        if isinstance(chunk[-1], dict):
-            last_mod = chunk[-1].get("modified")
-        if last_mod:
-            save_sync_state(conn, library_id, last_mod)
-
-        dt = time.time() - t0
-        log(f"Pagina {page_no}: +{len(chunk)} righe (tot={inserted}) — {dt:.3f}s")
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        # anche dopo un errore: le pagine già committate restano, e così gli indici
+        if deferred:
+            _restore_indexes(conn, deferred)
 
-    log(f"Import completato: {inserted} righe totali")
+    log("Import completato: %d righe totali", inserted)
     return inserted
 # ---------------------------------------------------------------------
 # Entry point batch
 # ---------------------------------------------------------------------
 
-def run_batch(db_path: str, batch_cfg: Dict[str, Dict[str, Any]], batch_path: str = ''):
-    conn = sqlite3.connect(db_path)
+def _open_import_conn(db_path: str) -> sqlite3.Connection:
+    # isolation_level=None: le transazioni (una per pagina) le apre l'import
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    ensure_pragmas(conn)
+    # import bulk: cache più grande (256 MiB) e checkpoint WAL meno frequenti
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("PRAGMA wal_autocheckpoint=10000")
+    # più writer (sezioni in parallelo, menu aperto): attesa del lock più lunga
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+def _run_section(conn, section: str, cfg: Dict[str, Any], batch_path: str) -> int:
+    table = cfg["table"]
+    library_id = cfg.get("library_id") or cfg.get("library")
+    if not library_id:
+        raise ValueError("library_id mancante")
+
+    sync = cfg.get("sync", "incremental")
+    limit = int(cfg.get("limit", 100))
+    # Optional: allow disabling detail enrichment to avoid long waits.
+    enrich_details = str(cfg.get("enrich_details", "true")).strip().lower() not in ("0","false","no","off")
+    prefetch = int(cfg.get("prefetch", 4))
+    commit_pages = int(cfg.get("commit_pages", 1))
+    defer_indexes = str(cfg.get("defer_indexes", "false")).strip().lower() in ("1","true","yes","on")
+    store_raw_json = str(cfg.get("store_raw_json", "true")).strip().lower() not in ("0","false","no","off")
+
+    log(
+        "Sezione [%s] → tabella '%s', libreria='%s', sync='%s', limit=%d",
+        section, table, library_id, sync, limit,
+    )
+
+    if sync == "incremental":
+        return import_library_incremental(
+            conn,
+            table=table,
+            library_id=library_id,
+            limit=limit,
+            enrich_details=enrich_details,
+            base_dir=os.path.dirname(os.path.abspath(batch_path)) if batch_path else os.getcwd(),
+            ini_path=batch_path if batch_path and batch_path.lower().endswith('.ini') else '',
+            section=section,
+            prefetch=prefetch,
+            commit_pages=commit_pages,
+            defer_indexes=defer_indexes,
+            store_raw_json=store_raw_json,
+        )
+    log_error("Modalità sync non supportata: %s", sync)
+    return 0
+
+def _run_sections_parallel(db_path: str, batch_cfg: Dict[str, Dict[str, Any]], batch_path: str, workers: int) -> int:
+    """Sezioni indipendenti su thread separati, una connessione per thread: la rete di
+    una sezione si sovrappone alle scritture di un'altra (i writer WAL si alternano
+    sulle transazioni per pagina, busy_timeout li fa attendere)."""
+    def _one(item):
+        section, cfg = item
+        c = _open_import_conn(db_path)
+        try:
+            return _run_section(c, section, cfg, batch_path)
+        finally:
+            c.close()
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(batch_cfg)), thread_name_prefix="section") as pool:
+        return sum(pool.map(_one, batch_cfg.items()))
+
+def run_batch(db_path: str, batch_cfg: Dict[str, Dict[str, Any]], batch_path: str = '', workers: int = 1):
+    """workers > 1: fino a `workers` sezioni in parallelo (solo su file, non :memory:)."""
+    # la connessione principale imposta WAL prima che partano eventuali worker
+    conn = _open_import_conn(db_path)
     total_inserted = 0
 
     try:
-        for section, cfg in batch_cfg.items():
-            table = cfg["table"]
-            library_id = cfg.get("library_id") or cfg.get("library")
-            if not library_id:
-                raise ValueError("library_id mancante")
-
-            sync = cfg.get("sync", "incremental")
-            limit = int(cfg.get("limit", 100))
-            # Optional: allow disabling detail enrichment to avoid long waits.
-            enrich_details = str(cfg.get("enrich_details", "true")).strip().lower() not in ("0","false","no","off")
-
-            log(
-                f"Sezione [{section}] → tabella '{table}', "
-                f"libreria='{library_id}', sync='{sync}', limit={limit}"
-            )
-
-            if sync == "incremental":
-                total_inserted += import_library_incremental(
-                    conn,
-                    table=table,
-                    library_id=library_id,
-                    limit=limit,
-                    enrich_details=enrich_details,
-                    base_dir=os.path.dirname(os.path.abspath(batch_path)) if batch_path else os.getcwd(),
-                    ini_path=batch_path if batch_path and batch_path.lower().endswith('.ini') else '',
-                    section=section,
-                )
-            else:
-                log_error(f"Modalità sync non supportata: {sync}")
+        if workers > 1 and len(batch_cfg) > 1 and db_path != ":memory:":
+            total_inserted = _run_sections_parallel(db_path, batch_cfg, batch_path, workers)
+        else:
+            for section, cfg in batch_cfg.items():
+                total_inserted += _run_section(conn, section, cfg, batch_path)
 
         return total_inserted
     except Exception as e:
-        log_error(f"Import batch fallito: {e}")
+        log_error("Import batch fallito: %s", e)
         raise
     finally:
         conn.close()
@@ -708,8 +1043,10 @@ def _load_batch_cfg_from_yaml(path: str) -> Dict[str, Dict[str, Any]]:
             "Installa con: pip install pyyaml"
         ) from e
 
+    # loader C (libyaml) se PyYAML è compilato con libyaml, altrimenti quello puro Python
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     with open(path, "r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
+        data = yaml.load(f, Loader=loader) or {}
 
     if isinstance(data, list):
         # supporta lista di oggetti {name:..., ...}
@@ -725,25 +1062,46 @@ def _load_batch_cfg_from_yaml(path: str) -> Dict[str, Dict[str, Any]]:
     if not isinstance(data, dict):
         raise ValueError("Formato YAML batch non valido: atteso dict o list")
 
-    out2: Dict[str, Dict[str, Any]] = {}
-    for section, cfg in data.items():
-        if not isinstance(cfg, dict):
-            continue
+    # sezioni così come le dà il loader, senza copia: il default di "table" lo mette
+    # _load_batch_cfg nella sua copia per chiamata (sezioni alias b: *a comprese)
+    return {str(section): cfg for section, cfg in data.items() if isinstance(cfg, dict)}
+
+@functools.lru_cache(maxsize=32)
+def _load_batch_cfg_cached(path: str, mtime_ns: int, size: int) -> Dict[str, Dict[str, Any]]:
+    # mtime_ns/size solo come chiave: un file modificato (anche dall'autodetect) si rilegge
+    if path.lower().endswith((".yaml", ".yml")):
+        return _load_batch_cfg_from_yaml(path)
+    return _load_batch_cfg_from_ini(path)
+
+def _load_batch_cfg(batch_path: str) -> Dict[str, Dict[str, Any]]:
+    path = os.path.abspath(batch_path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        # file mancante: lascia al loader il messaggio d'errore di sempre
+        return _load_batch_cfg_cached.__wrapped__(path, 0, 0)
+    cached = _load_batch_cfg_cached(path, st.st_mtime_ns, st.st_size)
+    # copia per chiamata: la cache non si sporca se il chiamante modifica le sezioni
+    out: Dict[str, Dict[str, Any]] = {}
+    for section, cfg in cached.items():
         d = dict(cfg)
+        # default: table = nome sezione
         d.setdefault("table", section)
-        out2[str(section)] = d
-    return out2
+        out[section] = d
+    return out
 
-def memento_import_batch(db_path: str, batch_path: str):
+def memento_import_batch(db_path: str, batch_path: str, workers: Optional[int] = None):
     """
     Entry point compatibile con il menu:
     - batch_path può essere .ini / .yaml / .yml
+    - workers > 1 importa più sezioni in parallelo (default: MEMENTO_IMPORT_WORKERS, altrimenti 1)
     Ritorna il numero totale di righe importate.
     """
     batch_path = batch_path.strip()
-    if batch_path.lower().endswith((".yaml", ".yml")):
-        batch_cfg = _load_batch_cfg_from_yaml(batch_path)
-    else:
-        batch_cfg = _load_batch_cfg_from_ini(batch_path)
-
-    return run_batch(db_path, batch_cfg, batch_path)
+    batch_cfg = _load_batch_cfg(batch_path)
+    if workers is None:
+        try:
+            workers = int(os.environ.get("MEMENTO_IMPORT_WORKERS", "1"))
+        except ValueError:
+            workers = 1
+    return run_batch(db_path, batch_cfg, batch_path, workers)
@@ -1,11 +1,19 @@
 # v13
 import os
 import re
+import functools
+import itertools
 import json
+import logging
+import sys
 import time
 import requests
 import socket
-from typing import Dict, Any, List, Optional, Iterable, Tuple
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Dict, Any, List, Mapping, Optional, Iterable, Tuple
 
 
 def _flatten_any(x: Any) -> List[Any]:
@@ -14,16 +22,24 @@ def _flatten_any(x: Any) -> List[Any]:
     The Memento API (or intermediaries) can occasionally return mixed/odd payloads.
     This avoids hard failures such as: `'int' object has no attribute 'get'`.
     """
-    out: List[Any] = []
+    if not isinstance(x, (list, tuple)):
+        return [x]
+    seq = (list, tuple)
+    if not any(isinstance(v, seq) for v in x):
+        return list(x)  # caso comune: pagina già piatta
 
-    def _walk(v: Any):
-        if isinstance(v, (list, tuple)):
-            for z in v:
-                _walk(z)
+    out: List[Any] = []
+    append = out.append
+    # pila di iteratori invece della ricorsione: stesso ordine, nessun limite di profondità
+    stack = [iter(x)]
+    while stack:
+        for v in stack[-1]:
+            if isinstance(v, seq):
+                stack.append(iter(v))
+                break
+            append(v)
         else:
-            out.append(v)
-
-    _walk(x)
+            stack.pop()
     return out
 
 
@@ -41,6 +57,34 @@ def _only_dicts(seq: Iterable[Any]) -> Tuple[List[Dict[str, Any]], int]:
             dropped += 1
     return kept, dropped
 
+_SESSION = None
+
+def _session():
+    """Sessione HTTP condivisa: connessioni TCP/TLS riusate tra le richieste
+    (anche dai thread del fetch dettagli)."""
+    global _SESSION
+    if _SESSION is None:
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        _SESSION = s
+    return _SESSION
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _pool() -> ThreadPoolExecutor:
+    """Executor condiviso per le richieste concorrenti (dettagli, probe): i thread
+    restano vivi tra pagine e sezioni; la concorrenza di ogni chiamata la limita
+    un semaforo, non la dimensione del pool."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="memento")
+    return _POOL
+
 def _get_with_backoff(url, *, params=None, timeout=None, max_tries=8, base_sleep=0.8, max_sleep=20.0):
     import random
     tries = 0
@@ -48,13 +92,13 @@ def _get_with_backoff(url, *, params=None, timeout=None, max_tries=8, base_sleep
     last_exc = None
     while tries < max_tries:
         try:
-            # Redact token from logs
-            _p = dict(params or {})
-            if "token" in _p:
-                _p["token"] = "***"
             if _debug_http():
-                _log(f"SDK → GET {url} params={_p} try={tries+1}/{max_tries}")
-            r = requests.get(url, params=params or {}, timeout=timeout or _timeout())
+                # Redact token from logs
+                _p = dict(params or {})
+                if "token" in _p:
+                    _p["token"] = "***"
+                _log("SDK → GET %s params=%s try=%d/%d", url, _p, tries + 1, max_tries)
+            r = _session().get(url, params=params or {}, timeout=timeout or _timeout())
             if r.status_code < 400 or r.status_code in (400,401,403,404):
                 return r
             if r.status_code == 429 or 500 <= r.status_code < 600:
@@ -93,7 +137,8 @@ except Exception:
     pass
 
 def _load_local_cfg():
-    cfg = {}
+    """settings.yaml/.yml/.ini locali. _cfg_get la chiama per ogni chiave (più volte
+    per richiesta HTTP): il parse si rifà solo se cambiano i file presenti o il loro mtime."""
     search_dirs = [
         os.getcwd(),
         os.path.dirname(os.path.abspath(__file__)),
@@ -102,8 +147,20 @@ def _load_local_cfg():
     ini_paths = [os.path.join(d, "settings.ini") for d in search_dirs]
     yml_paths = [os.path.join(d, "settings.yaml") for d in search_dirs] + [os.path.join(d, "settings.yml") for d in search_dirs]
 
-    for p in yml_paths:
-        if os.path.exists(p):
+    files = []
+    for kind, paths in (("yml", yml_paths), ("ini", ini_paths)):
+        for p in paths:
+            try:
+                files.append((kind, p, os.stat(p).st_mtime_ns))
+            except OSError:
+                pass
+    return _parse_local_cfg(tuple(files))
+
+@functools.lru_cache(maxsize=8)
+def _parse_local_cfg(files) -> Mapping[str, Any]:
+    cfg = {}
+    for kind, p, _mtime in files:
+        if kind == "yml":
             try:
                 import yaml  # type: ignore
             except Exception:
@@ -119,9 +176,7 @@ def _load_local_cfg():
                                     cfg[f"{sect}.{k}"] = v
                 except Exception:
                     pass
-
-    for p in ini_paths:
-        if os.path.exists(p):
+        else:
             import configparser
             cp = configparser.ConfigParser()
             try:
@@ -132,7 +187,8 @@ def _load_local_cfg():
             except Exception:
                 pass
 
-    return cfg
+    # condiviso dalla cache: in sola lettura
+    return MappingProxyType(cfg)
 
 def _cfg_get(key: str, default=None):
     val = None
@@ -167,15 +223,16 @@ def _base_url() -> str:
     u = _cfg_get("memento.api_url", "https://api.mementodatabase.com/v1")
     return _sanitize_url(u or "" )
 
-def _ts() -> str:
-    return time.strftime("%Y-%m-%d %H:%M:%S")
-
-def _log(msg: str):
-    try:
-        print(f"[{_ts()}] {msg}")
-    except Exception:
-        # Never fail due to logging
-        pass
+_logger = logging.getLogger("memento_sdk")
+if not _logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    _logger.addHandler(_handler)
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+def _log(msg: str, *args):
+    # %-formatting pigro; gli errori di scrittura li assorbe l'handler (mai un'eccezione qui)
+    _logger.info(msg, *args)
 
 
 
@@ -207,6 +264,36 @@ def _timeout():
 
     return (connect, read)
 
+def _detail_workers() -> int:
+    """Richieste di dettaglio in parallelo (memento.detail_workers, default 8)."""
+    try:
+        return max(1, int(_cfg_get("memento.detail_workers", 8)))
+    except Exception:
+        return 8
+
+def _detail_or_error(library_id: str, entry_id: str):
+    """(dettaglio, None) oppure (None, eccezione): un errore non interrompe il giro sui dettagli."""
+    try:
+        return fetch_entry_detail(library_id, entry_id), None
+    except Exception as ex:
+        return None, ex
+
+def _details_windowed(library_id: str, ids: List[str]) -> Iterable[Tuple[Any, Any]]:
+    """(dettaglio, errore) per ogni id, nell'ordine dato. Al massimo
+    _detail_workers() richieste in volo sul pool condiviso: la finestra limita
+    i submit, così i thread liberi restano agli altri utenti del pool."""
+    pool = _pool()
+    it = iter(ids)
+    window: deque = deque()
+    for eid in itertools.islice(it, _detail_workers()):
+        window.append(pool.submit(_detail_or_error, library_id, eid))
+    while window:
+        res = window.popleft().result()
+        nxt = next(it, None)
+        if nxt is not None:
+            window.append(pool.submit(_detail_or_error, library_id, nxt))
+        yield res
+
 def _token_params() -> Dict[str, Any]:
     token = _cfg_get("memento.token", "").strip()
     return {"token": token} if token else {}
@@ -261,7 +348,9 @@ def list_libraries():
         })
     return out
 
-def fetch_all_entries_full(library_id, limit=100, *, progress=None):
+def fetch_all_entries_full_pages(library_id, limit=100, *, progress=None):
+    """Generator: come fetch_all_entries_full, ma una pagina (lista di entry) alla volta;
+    la pagina successiva si richiede solo quando il chiamante la chiede."""
     import urllib.parse as _up
     base = _base_url().rstrip("/")
     url = f"{base}/libraries/{library_id}/entries"
@@ -287,7 +376,6 @@ def fetch_all_entries_full(library_id, limit=100, *, progress=None):
                 items = flat
         return items
 
-    all_rows = []
     while True:
         _t0 = time.time()
 
@@ -316,7 +404,7 @@ def fetch_all_entries_full(library_id, limit=100, *, progress=None):
                 rows2.append(d.json())
             rows = rows2
 
-        all_rows.extend(rows)
+        yield rows
 
         next_url = None
         if isinstance(data, dict):
@@ -363,9 +451,43 @@ def fetch_all_entries_full(library_id, limit=100, *, progress=None):
 
         break
 
+def fetch_all_entries_full(library_id, limit=100, *, progress=None):
+    all_rows = []
+    for rows in fetch_all_entries_full_pages(library_id, limit, progress=progress):
+        all_rows.extend(rows)
     return all_rows
 
+# library_id -> capacità dell'endpoint entries, sondate una volta per processo
+# (solo esiti certi: dopo un 5xx/429 si risonda alla chiamata successiva)
+_CAPS_CACHE: Dict[str, Dict[str, Any]] = {}
+
+def _transient(r) -> bool:
+    """Risposta che non dice nulla sul parametro provato: server in errore o troppe richieste."""
+    return r is None or r.status_code == 429 or r.status_code >= 500
+
+def _probe_first_ok(url: str, variants, ok=lambda r: r.status_code < 400):
+    """Prova i parametri nell'ordine dato, si ferma al primo accettato.
+    Ritorna (parametri accettati o None, esito certo)."""
+    certain = True
+    for extra in variants:
+        rr = _get_with_backoff(url, params={**_token_params(), "limit": 1, **extra}, timeout=_timeout())
+        if _transient(rr):
+            certain = False
+            continue
+        if ok(rr):
+            return extra, True
+    return None, certain
+
 def probe_capabilities(library_id: str):
+    caps = _CAPS_CACHE.get(library_id)
+    if caps is None:
+        caps, certain = _probe_capabilities(library_id)
+        if certain:
+            _CAPS_CACHE[library_id] = caps
+    return dict(caps)
+
+def _probe_capabilities(library_id: str):
+    """(capacità, esito certo): incerto se una prova è finita in 5xx/429."""
     base = _base_url().rstrip("/")
     url = f"{base}/libraries/{library_id}/entries"
     caps = {
@@ -376,35 +498,25 @@ def probe_capabilities(library_id: str):
         "accepts_pageToken": False
     }
 
-    r = _get_with_backoff(url, params={**_token_params(), "limit": 1}, timeout=_timeout())
-    try:
-        _ = r.json()
-    except Exception:
-        pass
-
-    for key in ("modifiedTime", "updated_at", "updated", "tempo", "time"):
-        rr = _get_with_backoff(url, params={**_token_params(), "limit": 1, "sort": key}, timeout=_timeout())
-        if rr.status_code < 400:
-            caps["accepts_sort"] = True
-            caps["sort_key"] = key
-            break
-
-    for p in ("updatedAfter", "modifiedAfter"):
-        rr = _get_with_backoff(url, params={**_token_params(), p: "1970-01-01T00:00:00Z", "limit": 1}, timeout=_timeout())
-        if rr.status_code < 400:
-            caps["accepts_updatedAfter"] = True
-            break
-    for p in ("createdAfter", "since"):
-        rr = _get_with_backoff(url, params={**_token_params(), p: "1970-01-01T00:00:00Z", "limit": 1}, timeout=_timeout())
-        if rr.status_code < 400:
-            caps["accepts_createdAfter"] = True
-            break
-
-    rr = _get_with_backoff(url, params={**_token_params(), "limit": 1, "pageToken": "dummy"}, timeout=_timeout())
-    if rr.status_code in (200, 400, 404):
-        caps["accepts_pageToken"] = True
-
-    return caps
+    epoch = "1970-01-01T00:00:00Z"
+    # i gruppi di prove sono indipendenti: in parallelo; dentro un gruppo resta il primo che passa
+    pool = _pool()
+    f_base = pool.submit(_probe_first_ok, url, [{}], lambda r: True)
+    f_sort = pool.submit(_probe_first_ok, url, [{"sort": k} for k in ("modifiedTime", "updated_at", "updated", "tempo", "time")])
+    f_upd = pool.submit(_probe_first_ok, url, [{p: epoch} for p in ("updatedAfter", "modifiedAfter")])
+    f_crt = pool.submit(_probe_first_ok, url, [{p: epoch} for p in ("createdAfter", "since")])
+    f_tok = pool.submit(_probe_first_ok, url, [{"pageToken": "dummy"}], lambda r: r.status_code in (200, 400, 404))
+
+    results = [f.result() for f in (f_base, f_sort, f_upd, f_crt, f_tok)]
+    _, sort, upd, crt, tok = (found for found, _ in results)
+    if sort:
+        caps["accepts_sort"] = True
+        caps["sort_key"] = sort["sort"]
+    caps["accepts_updatedAfter"] = upd is not None
+    caps["accepts_createdAfter"] = crt is not None
+    caps["accepts_pageToken"] = tok is not None
+
+    return caps, all(certain for _, certain in results)
 
 def fetch_incremental_pages(
     library_id: str,
@@ -505,27 +617,27 @@ def fetch_incremental_pages(
                 except Exception:
                     pass
 
-            for i, e in enumerate(chunk_dicts, start=1):
-                try:
-                    det = fetch_entry_detail(library_id, str(e.get("id")))
-                    if isinstance(det, dict):
-                        out.append(det)
-                    else:
-                        failed_ids.append(str(e.get("id")))
-                except Exception as ex:
-                    failed_ids.append(str(e.get("id")))
-                    if progress:
-                        try:
-                            progress({
-                                "phase": "detail_failed",
-                                "done": i,
-                                "total": total,
-                                "failed": len(failed_ids),
-                                "error": str(ex)[:200],
-                            })
-                        except Exception:
-                            pass
-                    continue
+            # dettagli in parallelo (I/O bound), restituiti nell'ordine della pagina
+            ids = [str(e.get("id")) for e in chunk_dicts]
+            results = _details_windowed(library_id, ids)
+            for i, (eid, (det, err)) in enumerate(zip(ids, results), start=1):
+                if isinstance(det, dict):
+                    out.append(det)
+                else:
+                    failed_ids.append(eid)
+                    if err is not None:
+                        if progress:
+                            try:
+                                progress({
+                                    "phase": "detail_failed",
+                                    "done": i,
+                                    "total": total,
+                                    "failed": len(failed_ids),
+                                    "error": str(err)[:200],
+                                })
+                            except Exception:
+                                pass
+                        continue
                 if progress and (i % 25 == 0 or i == total):
                     try:
                         progress({"phase": "details", "done": i, "total": total, "failed": len(failed_ids)})